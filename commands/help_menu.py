@@ -70,6 +70,28 @@ def create_help_embeds():
     mentions_embed.add_field(name="Note", value="This can help reduce noise in busy channels.", inline=False)
     embeds.append(mentions_embed)
 
+    # Toggle Context Scope
+    context_scope_embed = discord.Embed(
+        title="Toggle Context Scope",
+        description="This feature controls whether I remember conversations server-wide or separately for each channel.",
+        color=discord.Color.blue()
+    )
+    context_scope_embed.add_field(name="Usage", value="Use the `/settings` command and click the 'Toggle Context Scope' button.", inline=False)
+    context_scope_embed.add_field(name="Effect", value="When set per channel, I only use messages from the channel I'm replying in as context. Otherwise I use messages from every allowed channel. History stored before channels were recorded is only used in the server-wide scope.", inline=False)
+    context_scope_embed.add_field(name="Note", value="Per-channel context keeps conversations in different channels from mixing and makes my replies faster in busy servers.", inline=False)
+    embeds.append(context_scope_embed)
+
+    # Toggle Streaming
+    streaming_embed = discord.Embed(
+        title="Toggle Streaming",
+        description="This feature controls whether my replies appear while I'm still writing them.",
+        color=discord.Color.blue()
+    )
+    streaming_embed.add_field(name="Usage", value="Use the `/settings` command and click the 'Toggle Streaming' button.", inline=False)
+    streaming_embed.add_field(name="Effect", value="When enabled, my reply is posted as soon as I start writing and keeps updating until it's done. Long replies continue in a new message once they reach Discord's length limit.", inline=False)
+    streaming_embed.add_field(name="Note", value="Only the finished reply is remembered, so streaming doesn't change what I recall later.", inline=False)
+    embeds.append(streaming_embed)
+
     # Filter Safety
     safety_embed = discord.Embed(
         title="Filter Safety",
@@ -142,6 +164,16 @@ def create_help_embeds():
     instruction_embed.add_field(name="Note", value="Please make sure to finalize the instruction file externally before importing it. Due to Discord limitations, future changes to the instruction file should be made outside of this feature.", inline=False)
     embeds.append(instruction_embed)
 
+    # Bot Status
+    status_embed = discord.Embed(
+        title="Bot Status",
+        description="This feature shows administrators how healthy this server's API keys are and how busy I am.",
+        color=discord.Color.blue()
+    )
+    status_embed.add_field(name="Usage", value="Use the `/bot_status` command.", inline=False)
+    status_embed.add_field(name="API Keys", value="A key that keeps failing with a model is paused for a while (🔴) and then tried again with a single request (🟡). Other keys keep answering in the meantime.", inline=False)
+    embeds.append(status_embed)
+
     return embeds
 
 async def setup_help_command(tree):
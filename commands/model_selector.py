@@ -1,12 +1,12 @@
 import discord
 from discord.ui import View
-import google.generativeai as genai
 import os
 import json
 import aiofiles
 import asyncio
 from lib.api_manager import APIManager
 from lib.config_manager import ConfigManager
+from lib.gemini_clients import registry
 from typing import List, Dict, Any, Optional
 from datetime import datetime, timedelta
 
@@ -37,10 +37,9 @@ async def get_models(guild_id: str, api_manager: APIManager) -> List[Dict[str, A
     if not api_key:
         raise ValueError("No valid API key found for this guild.")
     
-    genai.configure(api_key=api_key)
-    
     models = []
-    for model in genai.list_models():
+    # Listed with the guild's own key, in a thread since the SDK call blocks
+    for model in await asyncio.to_thread(registry.list_models, api_key):
         if model.name.startswith("models/gemini-"):
             model_data = {
                 'name': model.name.split('models/')[1],
@@ -45,8 +45,7 @@ class ExtraView(PersistentView):
 
     async def clear_history_action(self, interaction: discord.Interaction):
         guild_id = str(interaction.guild_id)
-        history = await self.bot.guild_history_manager.get_guild_history(guild_id)
-        interaction_count = len(history)
+        interaction_count = await self.bot.guild_history_manager.get_history_count(guild_id)
 
         confirm_view = ConfirmView(self.clear_history_callback)
         embed = discord.Embed(
@@ -162,6 +161,46 @@ class ExtraView(PersistentView):
         await asyncio.sleep(8)
         await message.delete()
 
+    @discord.ui.button(label="Toggle Context Scope", style=discord.ButtonStyle.primary, emoji="🧵", custom_id="toggle_context_scope_button")
+    async def toggle_context_scope(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.handle_interaction(interaction, self.toggle_context_scope_action)
+
+    async def toggle_context_scope_action(self, interaction: discord.Interaction):
+        guild_id = str(interaction.guild_id)
+        config = await self.config_manager.get_guild_config(guild_id)
+        new_scope = "guild" if config.get("context_scope", "guild") == "channel" else "channel"
+        await self.config_manager.update_guild_config(guild_id, "context_scope", new_scope)
+        status = "each channel's own messages" if new_scope == "channel" else "messages from every allowed channel"
+
+        embed = discord.Embed(
+            title="Context Scope Updated",
+            description=f"Replies will now use {status} as context.",
+            color=discord.Color.green()
+        )
+        message = await interaction.response.send_message(embed=embed, ephemeral=True)
+        await asyncio.sleep(8)
+        await message.delete()
+
+    @discord.ui.button(label="Toggle Streaming", style=discord.ButtonStyle.primary, emoji="⚡", custom_id="toggle_streaming_button")
+    async def toggle_streaming(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.handle_interaction(interaction, self.toggle_streaming_action)
+
+    async def toggle_streaming_action(self, interaction: discord.Interaction):
+        guild_id = str(interaction.guild_id)
+        config = await self.config_manager.get_guild_config(guild_id)
+        new_streaming = not config.get("stream_responses", False)
+        await self.config_manager.update_guild_config(guild_id, "stream_responses", new_streaming)
+        status = "appear as they are written" if new_streaming else "appear once they are complete"
+
+        embed = discord.Embed(
+            title="Streaming Updated",
+            description=f"Replies will now {status}.",
+            color=discord.Color.green()
+        )
+        message = await interaction.response.send_message(embed=embed, ephemeral=True)
+        await asyncio.sleep(8)
+        await message.delete()
+
     @discord.ui.button(label="LLM Settings", style=discord.ButtonStyle.primary, emoji="⚙️", custom_id="llm_settings_button")
     async def llm_settings(self, interaction: discord.Interaction, button: discord.ui.Button):
         await self.handle_interaction(interaction, self.llm_settings_action)
@@ -231,6 +270,8 @@ async def setup_commands(tree: app_commands.CommandTree, bot, config_manager: Co
         embed.add_field(name="Clear Context 🗑️", value="Clear all chat interactions from bot memory", inline=True)
         embed.add_field(name="Toggle RP Mode 🎭", value="Enable or disable Role Play mode", inline=True)
         embed.add_field(name="Toggle Mentions 💬", value="Toggle whether the bot requires a mention to respond", inline=True)
+        embed.add_field(name="Toggle Context Scope 🧵", value="Share context across channels or keep it per channel", inline=True)
+        embed.add_field(name="Toggle Streaming ⚡", value="Show replies while they are being written", inline=True)
         embed.add_field(name="LLM Settings ⚙️", value="Configure LLM parameters", inline=True)
         embed.add_field(name="System Instruction 📝", value="Set the system instruction for the bot", inline=True)
         embed.add_field(name="Select Model 🤖", value="Choose the Gemini model to use", inline=True)
@@ -240,8 +281,12 @@ async def setup_commands(tree: app_commands.CommandTree, bot, config_manager: Co
         guild_config = await config_manager.get_guild_config(str(interaction.guild_id))
         mention_status = "required" if guild_config.get("require_mention", False) else "not required"
         rp_status = "enabled" if guild_config.get("rp_mode_enabled", False) else "disabled"
+        scope_status = "per channel" if guild_config.get("context_scope", "guild") == "channel" else "shared across the server"
+        streaming_status = "enabled" if guild_config.get("stream_responses", False) else "disabled"
         embed.add_field(name="Mention Requirement 💬", value=f"```Currently {mention_status}```", inline=False)
         embed.add_field(name="Role Play Mode 🎭", value=f"```Currently {rp_status}```", inline=False)
+        embed.add_field(name="Context Scope 🧵", value=f"```Currently {scope_status}```", inline=False)
+        embed.add_field(name="Streaming ⚡", value=f"```Currently {streaming_status}```", inline=False)
         
         view = ExtraView(bot, config_manager, api_manager)
         await interaction.response.send_message(embed=embed, view=view, ephemeral=True)    # Add the persistent view to the bot
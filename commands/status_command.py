@@ -0,0 +1,54 @@
+import discord
+from discord import app_commands
+
+from lib.circuit_breaker import breakers, OPEN, HALF_OPEN
+from lib.gemini_clients import registry
+
+STATE_LABELS = {OPEN: "🔴 Open", HALF_OPEN: "🟡 Probing"}
+
+def create_status_embed(client: discord.Client, api_keys) -> discord.Embed:
+    embed = discord.Embed(title="Bot Status", color=discord.Color.blue())
+
+    # Only this server's own keys are listed, and never in full
+    lines = []
+    for api_key, model_name, status in breakers.status(api_keys):
+        state = STATE_LABELS.get(status["state"], "🟢 Closed")
+        line = f"`...{api_key[-4:]}` {model_name}: {state}, {status['failures']} failures in a row, tripped {status['trips']}x"
+        if status["state"] == OPEN:
+            line += f", probing in {status['retry_in']:.0f}s"
+        if status["last_error"]:
+            line += f" (last: {status['last_error']})"
+        lines.append(line)
+    embed.add_field(name="API Keys", value="\n".join(lines)[:1024] if lines else "No requests made with this server's keys yet.", inline=False)
+
+    limiter = client.gemini_model.limiter.stats()
+    embed.add_field(name="Gemini Calls", value=(
+        f"{limiter['active']}/{limiter['limit']} running, {limiter['waiting']} waiting, {limiter['failures']} failed\n"
+        f"Slot wait: avg {limiter['queue_wait']['avg']:.2f}s, max {limiter['queue_wait']['max']:.2f}s\n"
+        f"Call time: avg {limiter['run_time']['avg']:.2f}s, max {limiter['run_time']['max']:.2f}s"
+    ), inline=False)
+
+    scheduler = client.scheduler.stats()
+    embed.add_field(name="Reply Queue", value=(
+        f"{scheduler['active']}/{scheduler['limit']} replies running, {scheduler['queued']} queued, {scheduler['rejected']} refused\n"
+        + "\n".join(f"Wait ({lane}): avg {stats['avg']:.2f}s, max {stats['max']:.2f}s" for lane, stats in scheduler['queue_wait'].items())
+    ), inline=False)
+
+    prefix_cache = client.gemini_model.prefix_cache.stats()
+    profiles = client.gemini_model.profiles.stats()
+    coalescer = client.coalescer.stats()
+    embed.add_field(name="Caches", value=(
+        f"Prompt prefixes: {prefix_cache['entries']} cached, {prefix_cache['hits']} hits, {prefix_cache['failures']} failures\n"
+        f"Generation profiles: {profiles['profiles']} kept, {profiles['builds']} built\n"
+        f"Client keys: {registry.stats()['keys']}\n"
+        f"Coalesced messages: {coalescer['coalesced']}, superseded replies: {coalescer['superseded']}"
+    ), inline=False)
+    return embed
+
+async def setup(tree: app_commands.CommandTree):
+    @tree.command(name="bot_status", description="Show API key health and generation load")
+    @app_commands.checks.has_permissions(administrator=True)
+    async def bot_status(interaction: discord.Interaction):
+        config = await interaction.client.config_manager.get_guild_config(str(interaction.guild_id))
+        embed = create_status_embed(interaction.client, config.get("api_keys", []))
+        await interaction.response.send_message(embed=embed, ephemeral=True)
@@ -5,6 +5,9 @@ from typing import List, Optional
 import asyncio
 import aiohttp
 
+from lib.circuit_breaker import breakers
+from lib.gemini_clients import registry
+
 class APIManager:
     def __init__(self, config_manager):
         self.config_manager = config_manager
@@ -12,12 +15,16 @@ class APIManager:
     async def create_api_modal(self, guild_id: str, current_api_keys: List[str]):
         return APIModal(self, guild_id, current_api_keys)
 
-    async def get_api_key(self, guild_id: str) -> Optional[str]:
+    async def get_api_key(self, guild_id: str, model_name: Optional[str] = None) -> Optional[str]:
         guild_config = await self.config_manager.get_guild_config(str(guild_id))
         api_keys = guild_config.get('api_keys', [])
         
         if not api_keys:
             return None
+
+        if model_name:
+            # Keys failing with this model are skipped; if they all are, the caller's breaker check fails fast
+            api_keys = breakers.available_keys(api_keys, model_name) or api_keys
         
         return random.choice(api_keys)
 
@@ -28,6 +35,8 @@ class APIManager:
         print(f"API Error occurred with key ending in ...{error_api_key[-4:]} for guild {guild_id}")
         
         remaining_keys = [key for key in api_keys if key != error_api_key]
+        registry.discard(error_api_key)
+        breakers.forget(error_api_key)
         if remaining_keys:
             new_key = random.choice(remaining_keys)
             await self.config_manager.update_guild_config(str(guild_id), 'api_keys', remaining_keys)
@@ -0,0 +1,114 @@
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))  # Failures in a row that open a breaker
+BREAKER_COOLDOWN = 30.0  # Seconds an open breaker waits before letting a probe request through
+BREAKER_MAX_COOLDOWN = 600.0  # The cooldown doubles after every failed probe, up to this
+BREAKER_PROBE_TIMEOUT = 90.0  # A probe that never reported back stops blocking the next one after this long
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Health of one API key with one model. Closed lets every request through;
+    enough failures in a row open it, and requests are refused without calling
+    Gemini. After the cooldown it is half-open: one probe request goes through,
+    and its outcome closes the breaker again or reopens it for longer.
+    """
+
+    def __init__(self, threshold: int = BREAKER_FAILURE_THRESHOLD, cooldown: float = BREAKER_COOLDOWN):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probe_started_at: Optional[float] = None
+        self.trips = 0
+        self.last_error: Optional[str] = None
+
+    def available(self) -> bool:
+        """Whether `allow` would let a request through, without claiming the probe."""
+        now = time.monotonic()
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return now - self.opened_at >= self.cooldown
+        return self.probe_started_at is None or now - self.probe_started_at >= BREAKER_PROBE_TIMEOUT
+
+    def allow(self) -> bool:
+        if not self.available():
+            return False
+        if self.state != CLOSED:
+            self.state = HALF_OPEN
+            self.probe_started_at = time.monotonic()
+        return True
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.failures = 0
+        self.cooldown = self.base_cooldown
+        self.probe_started_at = None
+
+    def record_failure(self, error: BaseException) -> None:
+        self.failures += 1
+        self.last_error = type(error).__name__
+        if self.state == HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, BREAKER_MAX_COOLDOWN)
+            self._open()
+        elif self.state == CLOSED and self.failures >= self.threshold:
+            self._open()
+
+    def record_neutral(self) -> None:
+        # The request failed for reasons that say nothing about the key or model, e.g. a blocked prompt
+        self.probe_started_at = None
+
+    def _open(self) -> None:
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.probe_started_at = None
+        self.trips += 1
+
+    def status(self) -> Dict[str, Any]:
+        retry_in = max(self.opened_at + self.cooldown - time.monotonic(), 0.0) if self.state == OPEN else 0.0
+        return {"state": self.state, "failures": self.failures, "trips": self.trips, "retry_in": retry_in, "last_error": self.last_error}
+
+
+class BreakerBoard:
+    """Circuit breakers by (API key, model name), created on first use."""
+
+    def __init__(self):
+        self.breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+    def get(self, api_key: str, model_name: str) -> CircuitBreaker:
+        breaker = self.breakers.get((api_key, model_name))
+        if breaker is None:
+            breaker = self.breakers[(api_key, model_name)] = CircuitBreaker()
+        return breaker
+
+    def available_keys(self, api_keys: List[str], model_name: str) -> List[str]:
+        return [api_key for api_key in api_keys if (api_key, model_name) not in self.breakers or self.breakers[(api_key, model_name)].available()]
+
+    def allow(self, api_key: str, model_name: str) -> bool:
+        return self.get(api_key, model_name).allow()
+
+    def forget(self, api_key: str) -> None:
+        # Called when a key is removed from a guild
+        for key in [key for key in self.breakers if key[0] == api_key]:
+            del self.breakers[key]
+
+    def status(self, api_keys: List[str]) -> List[Tuple[str, str, Dict[str, Any]]]:
+        """(key, model, status) for every breaker of the given keys."""
+        return [(api_key, model_name, breaker.status()) for (api_key, model_name), breaker in sorted(self.breakers.items()) if api_key in api_keys]
+
+
+# Shared by every guild, since guilds can use the same keys
+breakers = BreakerBoard()
@@ -12,6 +12,8 @@ class ConfigManager:
     def __init__(self):
         self.guild_configs_cache: Dict[str, Dict[str, Any]] = {}
         self.default_config: Dict[str, Any] = {}
+        # Bumped on every save, so anything derived from a guild's config knows when to rebuild
+        self.config_versions: Dict[str, int] = {}
         self.lock = asyncio.Lock()
 
     async def load_default_config(self):
@@ -47,6 +49,10 @@ class ConfigManager:
         async with aiofiles.open(config_path, 'w') as f:
             await f.write(json.dumps(config, indent=4))
         self.guild_configs_cache[guild_id] = config
+        self.config_versions[guild_id] = self.config_versions.get(guild_id, 0) + 1
+
+    def config_version(self, guild_id: str) -> int:
+        return self.config_versions.get(guild_id, 0)
 
     async def update_guild_config(self, guild_id: str, key: str, value: Any) -> None:
         config = await self.get_guild_config(guild_id)
@@ -80,7 +86,9 @@ class ConfigManager:
                 "allowed_channels": [],
                 "require_mention": False,
                 "model_name": "gemini-1.5-flash-latest",
-                "rp_mode_enabled": False
+                "rp_mode_enabled": False,
+                "context_scope": "guild",
+                "stream_responses": False
             }
             async with aiofiles.open(DEFAULT_CONFIG_PATH, 'w') as f:
                 await f.write(json.dumps(default_config, indent=4))
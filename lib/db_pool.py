@@ -0,0 +1,143 @@
+import os
+import time
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, Optional, Callable, Awaitable, AsyncIterator
+
+import aiosqlite
+
+# Pragmas applied to every pooled connection. Negative cache_size is in KiB.
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', '-16000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(64 * 1024 * 1024)))
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+# Only takes effect for new database files; existing ones switch over on their next VACUUM
+SQLITE_AUTO_VACUUM = os.getenv('SQLITE_AUTO_VACUUM', 'INCREMENTAL')
+
+IDLE_TIMEOUT = 300  # Seconds a connection may stay unused before it is closed
+EVICTION_INTERVAL = 60
+MAX_CONNECTIONS = 256
+
+
+class PooledConnection:
+    def __init__(self, db_path: str, db: aiosqlite.Connection):
+        self.db_path = db_path
+        self.db = db
+        self.lock = asyncio.Lock()
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+    """
+    Keeps one long-lived aiosqlite connection per database file.
+    Access to a connection is serialized with a per-connection lock so a
+    transaction started by one coroutine is never committed by another.
+    """
+
+    def __init__(self,
+                 on_open: Optional[Callable[[aiosqlite.Connection], Awaitable[None]]] = None,
+                 cache_size: int = SQLITE_CACHE_SIZE,
+                 mmap_size: int = SQLITE_MMAP_SIZE,
+                 synchronous: str = SQLITE_SYNCHRONOUS,
+                 auto_vacuum: str = SQLITE_AUTO_VACUUM,
+                 idle_timeout: float = IDLE_TIMEOUT,
+                 max_connections: int = MAX_CONNECTIONS):
+        self.on_open = on_open
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.synchronous = synchronous
+        self.auto_vacuum = auto_vacuum
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+        self.connections: Dict[str, PooledConnection] = {}
+        self.open_lock = asyncio.Lock()
+        self.eviction_task: Optional[asyncio.Task] = None
+
+    async def _open(self, db_path: str) -> PooledConnection:
+        db = await aiosqlite.connect(db_path)
+        try:
+            # Must come before anything is written to a new file
+            await db.execute(f'PRAGMA auto_vacuum={self.auto_vacuum}')
+            await db.execute('PRAGMA journal_mode=WAL')
+            await db.execute(f'PRAGMA synchronous={self.synchronous}')
+            await db.execute(f'PRAGMA cache_size={int(self.cache_size)}')
+            await db.execute(f'PRAGMA mmap_size={int(self.mmap_size)}')
+            if self.on_open:
+                await self.on_open(db)
+        except BaseException:
+            # Otherwise a failed migration leaves the connection and its thread behind on every retry
+            await db.close()
+            raise
+        return PooledConnection(db_path, db)
+
+    async def _get(self, db_path: str) -> PooledConnection:
+        pooled = self.connections.get(db_path)
+        if pooled is not None:
+            return pooled
+
+        async with self.open_lock:
+            pooled = self.connections.get(db_path)
+            if pooled is None:
+                if len(self.connections) >= self.max_connections:
+                    await self._evict_least_recently_used()
+                pooled = await self._open(db_path)
+                self.connections[db_path] = pooled
+            return pooled
+
+    @asynccontextmanager
+    async def connection(self, db_path: str) -> AsyncIterator[aiosqlite.Connection]:
+        while True:
+            pooled = await self._get(db_path)
+            await pooled.lock.acquire()
+            # The connection may have been evicted while we were waiting for it
+            if self.connections.get(db_path) is pooled:
+                break
+            pooled.lock.release()
+
+        try:
+            yield pooled.db
+        finally:
+            pooled.last_used = time.monotonic()
+            pooled.lock.release()
+
+    async def _close(self, pooled: PooledConnection) -> None:
+        self.connections.pop(pooled.db_path, None)
+        try:
+            await pooled.db.close()
+        except Exception as e:
+            print(f"Error closing database {pooled.db_path}: {e}")
+
+    async def _evict_least_recently_used(self) -> None:
+        idle = [p for p in self.connections.values() if not p.lock.locked()]
+        if idle:
+            await self._close(min(idle, key=lambda p: p.last_used))
+
+    async def evict_idle(self) -> int:
+        now = time.monotonic()
+        evicted = 0
+        for pooled in list(self.connections.values()):
+            if pooled.lock.locked() or now - pooled.last_used < self.idle_timeout:
+                continue
+            async with pooled.lock:
+                await self._close(pooled)
+            evicted += 1
+        return evicted
+
+    async def _eviction_loop(self) -> None:
+        while True:
+            await asyncio.sleep(EVICTION_INTERVAL)
+            try:
+                await self.evict_idle()
+            except Exception as e:
+                print(f"Error evicting idle database connections: {e}")
+
+    def start(self) -> None:
+        if self.eviction_task is None or self.eviction_task.done():
+            self.eviction_task = asyncio.get_running_loop().create_task(self._eviction_loop())
+
+    async def close_all(self) -> None:
+        if self.eviction_task:
+            self.eviction_task.cancel()
+            self.eviction_task = None
+        for pooled in list(self.connections.values()):
+            async with pooled.lock:
+                await self._close(pooled)
@@ -1,11 +1,14 @@
 import discord
 from google.generativeai.types import BlockedPromptException, BrokenResponseError, IncompleteIterationError, StopCandidateException
-from google.api_core.exceptions import PermissionDenied, ResourceExhausted, AlreadyExists, InvalidArgument, RetryError, InternalServerError, NotFound
+from google.api_core.exceptions import PermissionDenied, ResourceExhausted, AlreadyExists, InvalidArgument, RetryError, InternalServerError, NotFound, ServiceUnavailable, DeadlineExceeded, FailedPrecondition
 from google.auth.exceptions import DefaultCredentialsError
 from typing import Optional, Union
 import logging
 import asyncio
 
+from lib.circuit_breaker import CircuitOpen
+from lib.retry_policy import FATAL, RATE_LIMITED, TRANSIENT, UNKNOWN
+
 class ErrorHandler:
     ERROR_MESSAGES = {
         BlockedPromptException: "I'm sorry, but I can't respond to that due to safety restrictions. Your prompt may contain sensitive or inappropriate content.",
@@ -20,6 +23,7 @@ class ErrorHandler:
         RetryError: "I'm having trouble connecting to the API. This might be due to network issues or temporary API unavailability. Please try again in a moment.",
         InternalServerError: "An internal server error occurred on the API side. This is likely a temporary issue. I'll keep trying to get a response, but if it persists, please report it to the bot administrator.",
         NotFound: "The requested resource wasn't found. This could be due to an invalid model name, non-existent file, or outdated API version. Please check your request parameters and try again.",
+        CircuitOpen: "The selected model keeps failing with every API key of this server, so I'm pausing requests to it for a moment. Please try again shortly, or ask an administrator to check /bot_status.",
     }
 
     BACKEND_ERROR_CODES = {
@@ -47,6 +51,9 @@ class ErrorHandler:
         }
     }
 
+    FATAL_ERRORS = (CircuitOpen, BlockedPromptException, StopCandidateException, PermissionDenied, AlreadyExists, InvalidArgument, NotFound, FailedPrecondition, DefaultCredentialsError)
+    TRANSIENT_ERRORS = (InternalServerError, ServiceUnavailable, DeadlineExceeded, RetryError, BrokenResponseError, IncompleteIterationError, asyncio.TimeoutError)
+
     def __init__(self):
         self.logger = logging.getLogger('AliciaBot')
         self.logger.setLevel(logging.ERROR)
@@ -55,15 +62,32 @@ class ErrorHandler:
         handler.setFormatter(formatter)
         self.logger.addHandler(handler)
 
+    def classify(self, error: BaseException) -> str:
+        """
+        Sorts an error into the class that decides whether and how it is retried.
+        """
+        if isinstance(error, ResourceExhausted):
+            return RATE_LIMITED
+        if isinstance(error, self.TRANSIENT_ERRORS):
+            return TRANSIENT
+        if isinstance(error, self.FATAL_ERRORS):
+            return FATAL
+        error_message = str(error)
+        if any(code in error_message for code in ("UNAVAILABLE", "DEADLINE_EXCEEDED", "INTERNAL")):
+            return TRANSIENT
+        if any(code in error_message for code in ("INVALID_ARGUMENT", "FAILED_PRECONDITION", "PERMISSION_DENIED", "NOT_FOUND")):
+            return FATAL
+        return UNKNOWN
+
     async def handle_error(self, error: Exception, channel: discord.TextChannel) -> Optional[discord.Embed]:
         """
         Handles various types of errors and sends user-friendly error messages in English using Discord embeds.
         """
         embed = discord.Embed(title="Error", color=discord.Color.red())
         
-        if isinstance(error, InternalServerError):
+        if isinstance(error, (InternalServerError, asyncio.TimeoutError)):
             embed.description = self.ERROR_MESSAGES[InternalServerError]
-            return None  # Signal to retry
+            return None  # Temporary; the caller reports that it gave up retrying
         
         error_type = type(error)
         if error_type in self.ERROR_MESSAGES:
@@ -0,0 +1,138 @@
+import os
+import mimetypes
+import pathlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import google.generativeai as genai
+from google.ai import generativelanguage as glm
+from google.generativeai import client as genai_client
+from google.generativeai import caching
+from google.protobuf import field_mask_pb2
+
+MAX_CLIENT_KEYS = 256  # API keys whose clients are kept; the least recently used are dropped
+
+
+class KeyClients:
+    """
+    The SDK clients for one API key. Each is created on first use; gRPC clients
+    are safe to share between concurrent requests.
+    """
+
+    def __init__(self, api_key: str):
+        self.client_options = {"api_key": api_key}
+        self._generative: Optional[glm.GenerativeServiceClient] = None
+        self._generative_async: Optional[glm.GenerativeServiceAsyncClient] = None
+        self._model: Optional[glm.ModelServiceClient] = None
+        self._file: Optional[genai_client.FileServiceClient] = None
+        self._cache: Optional[glm.CacheServiceClient] = None
+
+    @property
+    def generative(self) -> glm.GenerativeServiceClient:
+        if self._generative is None:
+            self._generative = glm.GenerativeServiceClient(client_options=self.client_options)
+        return self._generative
+
+    @property
+    def generative_async(self) -> glm.GenerativeServiceAsyncClient:
+        # Created from a coroutine, so the gRPC channel belongs to the running event loop
+        if self._generative_async is None:
+            self._generative_async = glm.GenerativeServiceAsyncClient(client_options=self.client_options)
+        return self._generative_async
+
+    @property
+    def model(self) -> glm.ModelServiceClient:
+        if self._model is None:
+            self._model = glm.ModelServiceClient(client_options=self.client_options)
+        return self._model
+
+    @property
+    def file(self) -> genai_client.FileServiceClient:
+        if self._file is None:
+            self._file = genai_client.FileServiceClient(client_options=self.client_options)
+        return self._file
+
+    @property
+    def cache(self) -> glm.CacheServiceClient:
+        if self._cache is None:
+            self._cache = glm.CacheServiceClient(client_options=self.client_options)
+        return self._cache
+
+
+class ClientRegistry:
+    """
+    Hands out SDK clients configured for a given API key, instead of switching
+    the process-wide key with genai.configure before every call. Two guilds
+    generating at the same time can then never end up using each other's keys.
+    """
+
+    def __init__(self, max_keys: int = MAX_CLIENT_KEYS):
+        self.max_keys = max_keys
+        self.clients: 'OrderedDict[str, KeyClients]' = OrderedDict()
+
+    def get(self, api_key: str) -> KeyClients:
+        clients = self.clients.get(api_key)
+        if clients is None:
+            clients = self.clients[api_key] = KeyClients(api_key)
+            while len(self.clients) > self.max_keys:
+                self.clients.popitem(last=False)
+        else:
+            self.clients.move_to_end(api_key)
+        return clients
+
+    def discard(self, api_key: str) -> None:
+        # Called when a key is removed from a guild, so its clients are not kept around
+        self.clients.pop(api_key, None)
+
+    def generative_model(self, api_key: str, cached_content: Optional[str] = None, **kwargs: Any) -> genai.GenerativeModel:
+        model = genai.GenerativeModel(**kwargs)
+        # GenerativeModel has no public way to take clients; it otherwise falls back to the global default ones
+        clients = self.get(api_key)
+        model._client = clients.generative
+        model._async_client = clients.generative_async
+        if cached_content:
+            # What GenerativeModel.from_cached_content sets, without fetching the cache through the default client
+            model._cached_content = cached_content
+        return model
+
+    def list_models(self, api_key: str) -> List[Any]:
+        """Blocks; run it in a thread."""
+        return list(genai.list_models(client=self.get(api_key).model))
+
+    def upload_file(self, api_key: str, path: str) -> genai.types.File:
+        """Blocks; run it in a thread. Mirrors genai.upload_file for a given key."""
+        mime_type, _ = mimetypes.guess_type(path)
+        if mime_type is None:
+            raise ValueError(f"Could not determine the mime type of {path}")
+        response = self.get(api_key).file.create_file(path=pathlib.Path(path), mime_type=mime_type, display_name=os.path.basename(path))
+        return genai.types.File(response)
+
+    def get_file(self, api_key: str, name: str) -> genai.types.File:
+        """Blocks; run it in a thread."""
+        if "/" not in name:
+            name = f"files/{name}"
+        return genai.types.File(self.get(api_key).file.get_file(name=name))
+
+    def create_cached_content(self, api_key: str, model_name: str, contents: Any, ttl: int, display_name: Optional[str] = None) -> str:
+        """Blocks; run it in a thread. Returns the name of the new cached content."""
+        request = caching.CachedContent._prepare_create_request(model=model_name, display_name=display_name, contents=contents, ttl=ttl)
+        return self.get(api_key).cache.create_cached_content(request).name
+
+    def update_cached_content_ttl(self, api_key: str, name: str, ttl: int) -> None:
+        """Blocks; run it in a thread."""
+        request = glm.UpdateCachedContentRequest(
+            cached_content=glm.CachedContent(name=name, ttl={"seconds": ttl}),
+            update_mask=field_mask_pb2.FieldMask(paths=["ttl"])
+        )
+        self.get(api_key).cache.update_cached_content(request)
+
+    def delete_cached_content(self, api_key: str, name: str) -> None:
+        """Blocks; run it in a thread."""
+        self.get(api_key).cache.delete_cached_content(glm.DeleteCachedContentRequest(name=name))
+
+    def stats(self) -> Dict[str, int]:
+        return {"keys": len(self.clients)}
+
+
+# Shared by everything that calls Gemini
+registry = ClientRegistry()
@@ -1,9 +1,8 @@
 import os
 import urllib.parse
 import asyncio
-import random
 from io import BytesIO
-from typing import List, Dict, Any, Optional, Callable
+from typing import List, Dict, Any, Optional, Callable, Awaitable
 
 import aiohttp
 import aiofiles
@@ -11,7 +10,25 @@ from PIL import Image
 import discord
 from discord.ext import commands
 import google.generativeai as genai
-from google.api_core import exceptions
+
+from lib.gemini_clients import registry
+from lib.generation_limiter import GenerationLimiter
+from lib.generation_profile import GenerationProfile, ProfileCache
+from lib.history_schema import sort_key_for
+from lib.history_summary import build_summary_prompt
+from lib.prefix_cache import GeminiPrefixStore, PrefixCache, PREFIX_CACHE, PREFIX_CACHE_MIN_TOKENS
+from lib.retry_policy import Deadline, Retrier, RATE_LIMITED, REPLY_DEADLINE, TRANSIENT
+from lib.circuit_breaker import CircuitOpen, breakers
+from lib.prompt_budget import TokenEstimator, TOKEN_CALIBRATION, fit_history, history_token_budget, media_tokens
+
+
+HISTORY_CHAR_BUDGET = 200000  # Characters of recent history sent with each request
+# With recall enabled, only this much recent history is sent, plus the best matching older turns
+RECALL_TOP_K = 0
+RECALL_WINDOW_CHARS = 20000
+# With summaries enabled, summarized turns are sent as their summaries and every turn after them in full
+HISTORY_SUMMARIES = False
+RECALL_MODE = 'text'  # 'text' ranks older turns by full-text match, 'vector' by embedding similarity
 
 
 # Default RP instructions to use if the file is not found
@@ -147,9 +164,22 @@ class GeminiModel:
         self.config_manager = config_manager
         self.error_handler = error_handler
         self.RP_INSTRUCTIONS = None
+        # Every Gemini request goes through this, so replies never block the event loop
+        self.limiter = GenerationLimiter()
+        self.profiles = ProfileCache()
+        self.token_estimator = TokenEstimator()
+        self.calibration_tasks = set()
+        self.prefix_cache = PrefixCache(GeminiPrefixStore(self.limiter))
 
     async def initialize(self):
         self.RP_INSTRUCTIONS = await self.load_rp_instructions()
+        self.profiles.clear()
+
+    def close(self) -> None:
+        for task in self.calibration_tasks:
+            task.cancel()
+        self.prefix_cache.close()
+        self.limiter.close()
 
     async def load_rp_instructions(self) -> str:
         try:
@@ -159,98 +189,218 @@ class GeminiModel:
             print("Warning: rp_instructions.md not found. Using default RP instructions.")
             return DEFAULT_RP_INSTRUCTIONS
 
-    async def setup_model(self, api_key: str) -> None:
-        genai.configure(api_key=api_key)
-
-    def get_model(self, guild_config: Dict[str, Any]) -> genai.GenerativeModel:
-        generation_config = {
-            "temperature": guild_config["temperature"],
-            "top_p": guild_config["top_p"],
-            "top_k": guild_config["top_k"],
-            "max_output_tokens": guild_config["max_output_tokens"],
-        }
-        
-        safety_settings = [
-            {"category": category, "threshold": level}
-            for category, level in guild_config["safety_settings"].items()
-        ]
+    def get_profile(self, guild_id: str, guild_config: Dict[str, Any]) -> GenerationProfile:
+        return self.profiles.get(str(guild_id), self.config_manager.config_version(str(guild_id)), guild_config, self.RP_INSTRUCTIONS)
 
-        return genai.GenerativeModel(
-            model_name=guild_config.get("model_name", "gemini-1.5-pro"),
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
+    def get_model(self, guild_id: str, guild_config: Dict[str, Any], api_key: str) -> genai.GenerativeModel:
+        return self.get_profile(guild_id, guild_config).model(api_key)
 
-    async def generate_response(self, message: discord.Message, guild_id: str, get_guild_config: Callable[[str], Dict[str, Any]], get_guild_history: Callable[[str], List[Dict[str, Any]]]) -> str:
-        guild_config = await get_guild_config(str(guild_id))
+    async def summarize(self, guild_id: str, turns: List[Dict[str, Any]], previous: Optional[str] = None) -> Optional[str]:
+        # Only guilds that turned summaries on spend API quota on them
+        guild_config = await self.config_manager.get_guild_config(str(guild_id))
+        if not guild_config.get("history_summaries", HISTORY_SUMMARIES):
+            return None
         api_key = await self.api_manager.get_api_key(guild_id)
+        if not api_key:
+            return None
+
+        model = self.get_profile(guild_id, guild_config).summary_model(api_key)
+        response = await self.limiter.run(lambda: model.generate_content_async(build_summary_prompt(turns, previous)))
+        return response.text.strip() or None
+
+    async def generate_response(self, message: discord.Message, guild_id: str, get_guild_config: Callable[[str], Dict[str, Any]], get_guild_history: Callable[..., List[Dict[str, Any]]], search_guild_history: Optional[Callable[..., List[Dict[str, Any]]]] = None, get_history_summaries: Optional[Callable[..., List[Dict[str, Any]]]] = None, on_partial: Optional[Callable[[str], Awaitable[None]]] = None, burst: Optional[List[discord.Message]] = None, reply_deadline: float = REPLY_DEADLINE, on_retry: Optional[Callable[[], Awaitable[None]]] = None) -> str:
+        """
+        Returns the reply text. With `on_partial`, the reply is streamed and the
+        callback receives the text generated so far after every chunk. `burst`
+        lists every message the reply answers as one turn, ending with `message`.
+        Failed attempts are retried for up to `reply_deadline` seconds, counted
+        from once any attachment is uploaded, then the error is raised.
+        """
+        guild_config = await get_guild_config(str(guild_id))
+        profile = self.get_profile(guild_id, guild_config)
+        model_name = profile.model_name
+        # Keys whose circuit breaker is open for this model are passed over while another one is healthy
+        api_key = await self.api_manager.get_api_key(guild_id, model_name)
         if not api_key:
             return "No valid API key found for this guild. Please add an API key using the /api_manager command."
-
-        await self.setup_model(api_key)
-        model = self.get_model(guild_config)
-
-        history = await get_guild_history(str(guild_id))
+        model = profile.model(api_key)
+
+        burst = burst or [message]
+        query = "\n".join(burst_message.content for burst_message in burst)
+        if profile.rp_mode:
+            formatted_message = query
+        else:
+            formatted_message = "\n".join(f"{burst_message.author.display_name}: {burst_message.content}" for burst_message in burst)
+
+        # Only one attachment is sent with a turn, so a burst sends its newest one
+        media_message = next((burst_message for burst_message in reversed(burst) if burst_message.attachments or burst_message.content.startswith(('http://', 'https://'))), message)
+        media = await self.process_media(media_message, api_key)
+        # An uploaded file belongs to its key's project, so a turn carrying one stays on the key it was uploaded with
+        key_pinned = media is not None and not isinstance(media, Image.Image)
+        # Started only now, so a slow upload doesn't eat the time the attempts are given
+        deadline = Deadline(reply_deadline)
+
+        # Everything but the history is fixed, so history gets what the model's input limit leaves over
+        system_tokens = self.token_estimator.estimate(model_name, profile.system_prompt)
+        history_tokens = history_token_budget(
+            profile.input_token_limit,
+            system_tokens,
+            self.token_estimator.estimate(model_name, formatted_message),
+            media_tokens(media)
+        )
+        history_chars = int(history_tokens * self.token_estimator.ratio(model_name))
+
+        # Only the newest turns that fit the budget are read, not the whole table
+        channel_id = message.channel.id if guild_config.get("context_scope", "guild") == "channel" else None
+        recall_top_k = guild_config.get("recall_top_k", RECALL_TOP_K) if search_guild_history else 0
+        # Summaries cover the whole guild, so they are not mixed into a single channel's context
+        use_summaries = get_history_summaries is not None and channel_id is None and guild_config.get("history_summaries", HISTORY_SUMMARIES)
+        if recall_top_k or use_summaries:
+            summaries = await get_history_summaries(str(guild_id)) if use_summaries else []
+            if use_summaries:
+                # Raw turns pick up right where the last summary ends, so nothing falls between the two
+                summarized_until = max(summary["last_sort_key"] for summary in summaries) if summaries else None
+                history = await get_guild_history(str(guild_id), max_chars=min(guild_config.get("history_char_budget", HISTORY_CHAR_BUDGET), history_chars), channel_id=channel_id, after_sort_key=summarized_until)
+            else:
+                history = await get_guild_history(str(guild_id), max_chars=min(guild_config.get("recall_window_chars", RECALL_WINDOW_CHARS), history_chars), channel_id=channel_id)
+            before_sort_key = sort_key_for(history[0]["message_id"], history[0]["timestamp"]) if history else None
+            if recall_top_k:
+                recalled = await search_guild_history(str(guild_id), query, recall_top_k, before_sort_key=before_sort_key, channel_id=channel_id, mode=guild_config.get("recall_mode", RECALL_MODE))
+                history = recalled + history
+            if summaries:
+                digest = "Summary of the earlier conversation:\n\n" + "\n\n".join(summary["content"] for summary in summaries)
+                history = [{"content": {"role": "user", "parts": [digest]}}] + history
+        else:
+            history = await get_guild_history(str(guild_id), max_chars=min(guild_config.get("history_char_budget", HISTORY_CHAR_BUDGET), history_chars), channel_id=channel_id)
         formatted_history = [
             {"role": "user" if item["content"]["role"] == "user" else "model", "parts": item["content"]["parts"]}
             for item in history
         ]
-
-        custom_prompt = (self.RP_INSTRUCTIONS + "\n\n") if guild_config.get("rp_mode_enabled", False) else ""
-        custom_prompt += guild_config["system_instruction"] + "\n\n"
-
-        formatted_history.insert(0, {"role": "model", "parts": [custom_prompt]})
-
-        formatted_message = message.content if guild_config.get("rp_mode_enabled", False) else f"{message.author.display_name}: {message.content}"
-
-        media = await self.process_media(message)
-
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                chat = model.start_chat(history=formatted_history)
-                if media:
-                    response = chat.send_message([formatted_message or "A file was sent:", media])
-                else:
-                    if not formatted_message.strip():
-                        return "I'm sorry, but I didn't receive any message to respond to. Could you please try again with a question or statement?"
-                    response = chat.send_message(formatted_message)
-                
-                if not response.text.strip():
-                    return "I apologize, but I couldn't generate a proper response. Could you please rephrase your question or provide more context?"
-                
-                return response.text
-            except exceptions.InternalServerError:
-                raise
-            except exceptions.ResourceExhausted:
+        # Recalled turns and summaries come on top of the window, so the whole history is fitted once more
+        formatted_history = fit_history(formatted_history, history_tokens, self.token_estimator, model_name)
+        formatted_history.insert(0, profile.system_turn)
+
+        if TOKEN_CALIBRATION and self.token_estimator.needs_calibration(model_name):
+            self.schedule_calibration(model, model_name, formatted_history + [{"role": "user", "parts": [formatted_message]}])
+
+        # A large prefix is sent once as cached content and then only referenced, while the cache is alive
+        cache_name = None
+        if guild_config.get("prefix_cache", PREFIX_CACHE) and system_tokens >= PREFIX_CACHE_MIN_TOKENS:
+            cache_name = self.prefix_cache.get(str(guild_id), api_key, profile.system_prompt, model_name, [profile.system_turn])
+        if cache_name:
+            model = profile.cached_model(api_key, cache_name)
+            formatted_history = formatted_history[1:]
+
+        if media:
+            content = [formatted_message or "A file was sent:", media]
+        else:
+            if not formatted_message.strip():
+                return "I'm sorry, but I didn't receive any message to respond to. Could you please try again with a question or statement?"
+            content = formatted_message
+
+        def use_key(new_api_key: str) -> None:
+            nonlocal api_key, model, cache_name
+            if cache_name:
+                # The cache belongs to the old key's project
+                self.prefix_cache.invalidate(str(guild_id), api_key)
+                cache_name = None
+                formatted_history.insert(0, profile.system_turn)
+            api_key = new_api_key
+            model = profile.model(api_key)
+
+        async def attempt(timeout: float) -> str:
+            if not breakers.allow(api_key, model_name):
+                if key_pinned:
+                    raise CircuitOpen(f"The API key this turn's file was uploaded with is failing with {model_name}")
+                # Fail over to a key whose breaker lets requests through, or fail without calling Gemini
+                other_api_key = await self.api_manager.get_api_key(guild_id, model_name)
+                if not other_api_key or other_api_key == api_key or not breakers.allow(other_api_key, model_name):
+                    raise CircuitOpen(f"Every API key of this guild is failing with {model_name}")
+                use_key(other_api_key)
+            # The SDK gets the same deadline, so a slow call is abandoned on Gemini's side too
+            request_options = {"timeout": timeout}
+            chat = model.start_chat(history=formatted_history)
+            if on_partial:
+                return await self.limiter.run(lambda: self.stream_message(chat, content, on_partial, request_options))
+            return (await self.limiter.run(lambda: chat.send_message_async(content, request_options=request_options))).text
+
+        async def recover(error: BaseException, error_class: str) -> bool:
+            nonlocal model, cache_name
+            if on_retry:
+                # The next attempt starts its text from scratch, so what the failed one streamed is taken down first
+                await on_retry()
+            if cache_name:
+                # Most likely the cache expired early or was deleted; retry with the prefix inline
+                self.prefix_cache.invalidate(str(guild_id), api_key)
+                cache_name = None
+                model = profile.model(api_key)
+                formatted_history.insert(0, profile.system_turn)
+            if error_class == RATE_LIMITED and not key_pinned:
                 new_api_key = await self.api_manager.handle_api_error(guild_id, api_key)
                 if new_api_key:
-                    api_key = new_api_key
-                    await self.setup_model(api_key)
-                    model = self.get_model(guild_config)
-                else:
-                    if attempt == max_retries - 1:
-                        return "I'm having trouble responding at the moment. Please try again later or contact an administrator to check the API keys."
-                await asyncio.sleep(2 ** attempt + random.random())
+                    self.profiles.discard_key(api_key)
+                    use_key(new_api_key)
+                    # A fresh key has its own quota, so there is nothing to wait for
+                    return True
+            if not key_pinned and not breakers.get(api_key, model_name).available():
+                other_api_key = await self.api_manager.get_api_key(guild_id, model_name)
+                if other_api_key and other_api_key != api_key:
+                    use_key(other_api_key)
+                    return True
+            return False
+
+        def observe(error: Optional[BaseException], error_class: Optional[str]) -> None:
+            breaker = breakers.get(api_key, model_name)
+            if error is None:
+                breaker.record_success()
+            elif error_class in (RATE_LIMITED, TRANSIENT):
+                breaker.record_failure(error)
+            elif not isinstance(error, CircuitOpen):
+                breaker.record_neutral()
+
+        # Retries happen only here; whatever is still failing at the deadline is raised to the caller
+        text = await Retrier(self.error_handler.classify, deadline).run(attempt, recover, observe)
+        if not text.strip():
+            return "I apologize, but I couldn't generate a proper response. Could you please rephrase your question or provide more context?"
+        return text
+
+    def schedule_calibration(self, model: genai.GenerativeModel, model_name: str, contents: List[Dict[str, Any]]) -> None:
+        # Runs next to the reply, whose prompt it measures, instead of delaying it
+        self.token_estimator.start_calibration(model_name)
+        chars = sum(len(part) for item in contents for part in item["parts"] if isinstance(part, str))
+
+        async def run() -> None:
+            try:
+                response = await self.limiter.run(lambda: model.count_tokens_async(contents))
+                self.token_estimator.calibrate(model_name, chars, response.total_tokens)
             except Exception as e:
-                if attempt == max_retries - 1:
-                    return f"An error occurred: {str(e)}"
-                await asyncio.sleep(2 ** attempt + random.random())
-
-        return "I'm having trouble responding at the moment. Please try again later."
-
-    async def process_media(self, message: discord.Message) -> Optional[Any]:
+                print(f"Error calibrating token estimates for {model_name}: {e}")
+
+        task = asyncio.get_running_loop().create_task(run())
+        self.calibration_tasks.add(task)
+        task.add_done_callback(self.calibration_tasks.discard)
+
+    async def stream_message(self, chat: Any, content: Any, on_partial: Callable[[str], Awaitable[None]], request_options: Optional[Dict[str, Any]] = None) -> str:
+        # Consumed inside the limiter slot, since the request is still running until the last chunk
+        response = await chat.send_message_async(content, stream=True, request_options=request_options)
+        text = ""
+        async for chunk in response:
+            text += chunk.text
+            await on_partial(text)
+        return text
+
+    async def process_media(self, message: discord.Message, api_key: str) -> Optional[Any]:
         if message.attachments:
             attachment = message.attachments[0]
             content_type = attachment.content_type
             if content_type.startswith('image'):
                 return await self.process_image(attachment.url)
             elif content_type.startswith('video'):
-                return await self.process_file(attachment.url, 'video')
+                return await self.process_file(attachment.url, 'video', api_key)
             elif content_type.startswith('audio'):
-                return await self.process_file(attachment.url, 'audio')
+                return await self.process_file(attachment.url, 'audio', api_key)
             elif content_type.startswith(('text', 'application')):
-                return await self.process_file(attachment.url, 'document', attachment.filename)
+                return await self.process_file(attachment.url, 'document', api_key, attachment.filename)
             else:
                 await self.send_incompatible_format_warning(message)
                 return None
@@ -260,12 +410,12 @@ class GeminiModel:
             if file_extension in ['.png', '.jpg', '.jpeg', '.gif', '.webp', '.heic', '.heif']:
                 return await self.process_image(url)
             elif file_extension in ['.mp4', '.avi', '.mov', '.mkv', '.webm', '.mpeg', '.wmv', '.3gpp']:
-                return await self.process_file(url, 'video')
+                return await self.process_file(url, 'video', api_key)
             elif file_extension in ['.wav', '.mp3', '.aiff', '.aac', '.ogg', '.flac']:
-                return await self.process_file(url, 'audio')
+                return await self.process_file(url, 'audio', api_key)
             elif file_extension in ['.txt', '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.ppt', '.pptx']:
                 filename = os.path.basename(urllib.parse.urlparse(url).path)
-                return await self.process_file(url, 'document', filename)
+                return await self.process_file(url, 'document', api_key, filename)
             else:
                 await self.send_incompatible_format_warning(message)
                 return None
@@ -279,7 +429,7 @@ class GeminiModel:
                     return Image.open(BytesIO(image_data))
         return None
 
-    async def process_file(self, url: str, file_type: str, filename: Optional[str] = None) -> Any:
+    async def process_file(self, url: str, file_type: str, api_key: str, filename: Optional[str] = None) -> Any:
         async with aiohttp.ClientSession() as session:
             async with session.get(url) as resp:
                 if resp.status == 200:
@@ -293,13 +443,14 @@ class GeminiModel:
                             f.write(file_data)
                         
                         print(f"Uploading {file_type} file: {filename}")
-                        file = genai.upload_file(path=filename)
+                        # Uploaded with the same key the reply is generated with, since files belong to a key's project
+                        file = await self.limiter.run_sync(registry.upload_file, api_key, filename)
                         print(f"Completed upload: {file.uri}")
 
                         while file.state.name == "PROCESSING":
                             print('.', end='')
                             await asyncio.sleep(10)
-                            file = genai.get_file(file.name)
+                            file = await self.limiter.run_sync(registry.get_file, api_key, file.name)
 
                         if file.state.name == "FAILED":
                             raise ValueError(file.state.name)
@@ -0,0 +1,87 @@
+import os
+import time
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar('T')
+
+GEMINI_CONCURRENCY = int(os.getenv('GEMINI_CONCURRENCY', '8'))  # Model calls in flight at once, across all guilds
+
+
+class TimingStats:
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {"count": self.count, "avg": self.total / self.count if self.count else 0.0, "max": self.max}
+
+
+class GenerationLimiter:
+    """
+    Bounds how many Gemini calls run at once and records how long each one
+    waited for a slot and how long it ran. Async SDK calls run on the event
+    loop; blocking ones go to a thread pool of the same size, so neither can
+    freeze the bot while a reply is generated.
+    """
+
+    def __init__(self, limit: int = GEMINI_CONCURRENCY):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.active = 0
+        self.waiting = 0
+        self.queue_wait = TimingStats()
+        self.run_time = TimingStats()
+        self.failures = 0
+
+    async def run(self, call: Callable[[], Awaitable[T]]) -> T:
+        queued_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.monotonic()
+        self.queue_wait.record(started_at - queued_at)
+        self.active += 1
+        try:
+            return await call()
+        except BaseException:
+            self.failures += 1
+            raise
+        finally:
+            self.active -= 1
+            self.run_time.record(time.monotonic() - started_at)
+            self.semaphore.release()
+
+    async def run_sync(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.limit, thread_name_prefix='gemini')
+        loop = asyncio.get_running_loop()
+        return await self.run(lambda: loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs)))
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "waiting": self.waiting,
+            "failures": self.failures,
+            "queue_wait": self.queue_wait.to_dict(),
+            "run_time": self.run_time.to_dict(),
+        }
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import google.generativeai as genai
+
+from lib.gemini_clients import registry
+from lib.history_summary import SUMMARY_MAX_CHARS
+from lib.prompt_budget import model_limits
+
+DEFAULT_MODEL_NAME = "gemini-1.5-pro"
+MAX_PROFILES = 1024  # Guild profiles kept; the least recently used are rebuilt on their next message
+
+
+class GenerationProfile:
+    """
+    Everything a guild's config contributes to a request, built once per config
+    version: generation settings, the safety list, the system prompt turn, the
+    selected model's token limits and a model per API key. Messages in between
+    reuse it as is.
+    """
+
+    def __init__(self, guild_config: Dict[str, Any], rp_instructions: Optional[str]):
+        self.model_name = guild_config.get("model_name", DEFAULT_MODEL_NAME)
+        self.rp_mode = guild_config.get("rp_mode_enabled", False)
+        self.input_token_limit, self.output_token_limit = model_limits.get(self.model_name)
+        self.generation_config = {
+            "temperature": guild_config["temperature"],
+            "top_p": guild_config["top_p"],
+            "top_k": guild_config["top_k"],
+            # A setting kept from a larger model would otherwise be rejected outright
+            "max_output_tokens": min(guild_config["max_output_tokens"], self.output_token_limit),
+        }
+        self.safety_settings = [
+            {"category": category, "threshold": level}
+            for category, level in guild_config["safety_settings"].items()
+        ]
+        custom_prompt = (rp_instructions + "\n\n") if self.rp_mode and rp_instructions else ""
+        self.system_prompt = custom_prompt + guild_config["system_instruction"] + "\n\n"
+        # Shared by every request; chat history only reads it
+        self.system_turn = {"role": "model", "parts": [self.system_prompt]}
+        self.models: Dict[str, genai.GenerativeModel] = {}
+        self.summary_models: Dict[str, genai.GenerativeModel] = {}
+        self.cached_models: Dict[str, Tuple[str, genai.GenerativeModel]] = {}
+
+    def model(self, api_key: str) -> genai.GenerativeModel:
+        model = self.models.get(api_key)
+        if model is None:
+            # Bound to the key's own clients rather than the process-wide genai.configure state
+            model = self.models[api_key] = registry.generative_model(
+                api_key,
+                model_name=self.model_name,
+                generation_config=self.generation_config,
+                safety_settings=self.safety_settings
+            )
+        return model
+
+    def cached_model(self, api_key: str, cached_content: str) -> genai.GenerativeModel:
+        """A model whose requests start with the system prompt already cached under `cached_content`."""
+        cached = self.cached_models.get(api_key)
+        if cached is None or cached[0] != cached_content:
+            cached = self.cached_models[api_key] = (cached_content, registry.generative_model(
+                api_key,
+                cached_content=cached_content,
+                model_name=self.model_name,
+                generation_config=self.generation_config,
+                safety_settings=self.safety_settings
+            ))
+        return cached[1]
+
+    def summary_model(self, api_key: str) -> genai.GenerativeModel:
+        model = self.summary_models.get(api_key)
+        if model is None:
+            model = self.summary_models[api_key] = registry.generative_model(
+                api_key,
+                model_name=self.model_name,
+                generation_config={"temperature": 0.2, "max_output_tokens": SUMMARY_MAX_CHARS // 3},
+                safety_settings=self.safety_settings
+            )
+        return model
+
+    def discard_key(self, api_key: str) -> None:
+        self.models.pop(api_key, None)
+        self.summary_models.pop(api_key, None)
+        self.cached_models.pop(api_key, None)
+
+
+class ProfileCache:
+    """
+    Generation profiles by guild, each tagged with the config version it was
+    built from. ConfigManager bumps the version on every save, so a profile is
+    rebuilt exactly when its guild's settings change.
+    """
+
+    def __init__(self, max_profiles: int = MAX_PROFILES):
+        self.max_profiles = max_profiles
+        self.profiles: 'OrderedDict[str, Tuple[Any, GenerationProfile]]' = OrderedDict()
+        self.builds = 0
+
+    def get(self, guild_id: str, version: Any, guild_config: Dict[str, Any], rp_instructions: Optional[str]) -> GenerationProfile:
+        cached = self.profiles.get(guild_id)
+        if cached is not None and cached[0] == version:
+            self.profiles.move_to_end(guild_id)
+            return cached[1]
+        profile = GenerationProfile(guild_config, rp_instructions)
+        self.profiles[guild_id] = (version, profile)
+        self.profiles.move_to_end(guild_id)
+        self.builds += 1
+        while len(self.profiles) > self.max_profiles:
+            self.profiles.popitem(last=False)
+        return profile
+
+    def discard_key(self, api_key: str) -> None:
+        for _, profile in self.profiles.values():
+            profile.discard_key(api_key)
+
+    def clear(self) -> None:
+        self.profiles.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"profiles": len(self.profiles), "builds": self.builds}
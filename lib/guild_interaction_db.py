@@ -1,101 +1,689 @@
 import os
-import aiosqlite
-from datetime import datetime
-from typing import List, Dict, Any, Optional
+import re
+import time
+import asyncio
+import discord
+from datetime import datetime, timedelta, timezone
+from typing import List, Dict, Any, Optional, Sequence, Set, Tuple
+
+from lib.db_pool import ConnectionPool
+from lib.history_archive import GuildArchive, ARCHIVE_ENABLED, ARCHIVE_MAX_AGE_DAYS, ARCHIVE_PAGE_ROWS
+from lib.history_cache import HistoryCache
+from lib.history_layout import get_db_path
+from lib.history_schema import migrate, sort_key_for, snowflake_from_datetime
+from lib.history_summary import Summarizer, SUMMARY_SPAN_TURNS, SUMMARY_KEEP_RECENT, SUMMARY_MAX_RECORDS, SUMMARY_MERGE_COUNT, SUMMARY_IDLE_SECONDS
+from lib.history_write_queue import HistoryWriteQueue, WriteOp
+from lib.vector_memory import VectorMemory
 
 MAX_CONTEXT_SIZE = 20000
+# Once a guild grows past MAX_CONTEXT_SIZE rows it is trimmed down to this many,
+# so the next trim is only needed after another couple of thousand messages
+CONTEXT_LOW_WATER_MARK = 18000
+MAINTENANCE_INTERVAL = 30  # Seconds between background trimming passes
+VACUUM_MIN_FREE_PAGES = 1024  # Free pages a trim must leave behind before the file is shrunk
+VACUUM_STEP_PAGES = 256  # Pages returned to the filesystem per connection hold
+SYNC_MAX_MESSAGES = 1000  # Newest messages fetched per channel in one sync pass
+SYNC_CONCURRENCY = 4  # Channels synced at once, to stay well inside Discord's rate limits
+CHARS_PER_TOKEN = 4  # Rough estimate used when a caller budgets history in tokens
+HISTORY_PAGE_SIZE = 200
+SEARCH_MAX_TERMS = 16  # Longest words of a query that are matched against the full-text index
+VECTOR_OVERFETCH = 4  # Extra candidates taken from a guild's vector index when filtering by channel
 
-async def initialize_db(db_path: str) -> None:
-    async with aiosqlite.connect(db_path) as db:
-        await db.execute('''
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                message_id TEXT UNIQUE,
-                role TEXT,
-                content TEXT,
-                timestamp DATETIME
-            )
-        ''')
-        await db.commit()
+# Opening a connection brings the database up to the current schema version
+pool = ConnectionPool(on_open=migrate)
+
+# Newest turns of active guilds, kept in step with every write below
+cache = HistoryCache()
+
+# Embeddings of each guild's turns for similarity recall, built the first time a guild asks for it
+vectors = VectorMemory()
+vector_builds: Dict[str, asyncio.Task] = {}
+
+# Guilds that crossed MAX_CONTEXT_SIZE, or may hold rows past ARCHIVE_MAX_AGE_DAYS, waiting for the maintenance task
+trim_pending: Set[str] = set()
+maintenance_task: Optional[asyncio.Task] = None
+sync_tasks: Dict[Tuple[str, int], asyncio.Task] = {}
+sync_limit = asyncio.Semaphore(SYNC_CONCURRENCY)
+
+# Older turns are folded into summaries by this, while the guild is idle; None disables compaction
+summarizer: Optional[Summarizer] = None
+summary_task: Optional[asyncio.Task] = None
+summary_pending: Set[str] = set()
+last_activity: Dict[str, float] = {}
+
+def scope_key(guild_id: str, channel_id: Optional[int] = None) -> str:
+    # Cache key for a guild's history, or for one channel's slice of it
+    return guild_id if channel_id is None else f'{guild_id}/{channel_id}'
+
+def scope_filter(guild_id: str, channel_id: Optional[int] = None) -> Tuple[str, Tuple[Any, ...]]:
+    if channel_id is None:
+        return 'guild_id = ?', (guild_id,)
+    return 'guild_id = ? AND channel_id = ?', (guild_id, channel_id)
+
+def invalidate_cache(guild_id: str) -> None:
+    cache.invalidate(guild_id)
+    cache.invalidate_prefix(f'{guild_id}/')
+
+async def upsert_row(db: Any, guild_id: str, params: Tuple[Any, ...]) -> str:
+    """Returns the message id of the row that was written."""
+    message_id, role, content, timestamp, sort_key, channel_id, chunk_ids = params
+
+    # An edit addressed to a later chunk of a split response updates the response's single row
+    async with db.execute('SELECT message_id FROM message_chunks WHERE chunk_id = ?', (message_id,)) as cursor:
+        mapped = await cursor.fetchone()
+    if mapped:
+        await db.execute('UPDATE messages SET role = ?, content = ? WHERE message_id = ? AND guild_id = ?', (role, content, mapped[0], guild_id))
+        return mapped[0]
+
+    # New messages are inserted, existing ones keep their original timestamp
+    await db.execute('''
+        INSERT INTO messages (message_id, role, content, timestamp, sort_key, channel_id, guild_id)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(message_id) DO UPDATE SET role = excluded.role, content = excluded.content,
+            channel_id = COALESCE(excluded.channel_id, channel_id)
+    ''', (message_id, role, content, timestamp, sort_key, channel_id, guild_id))
+    if chunk_ids:
+        await db.executemany('INSERT OR REPLACE INTO message_chunks (chunk_id, message_id) VALUES (?, ?)',
+                             [(chunk_id, message_id) for chunk_id in chunk_ids])
+    return message_id
+
+async def delete_row(db: Any, guild_id: str, message_id: str) -> Optional[str]:
+    """Returns the row's new message id when the first chunk of a split response was deleted."""
+    # Deleting one chunk of a split response only forgets that chunk; the text goes with the last one
+    cursor = await db.execute('DELETE FROM message_chunks WHERE chunk_id = ?', (message_id,))
+    if cursor.rowcount:
+        return None
+
+    async with db.execute('SELECT MIN(chunk_id) FROM message_chunks WHERE message_id = ?', (message_id,)) as cursor:
+        next_id = (await cursor.fetchone())[0]
+    if next_id is None:
+        await db.execute('DELETE FROM messages WHERE message_id = ? AND guild_id = ?', (message_id, guild_id))
+        return None
+
+    # The first chunk was deleted, so the next one becomes the row's message id
+    await db.execute('DELETE FROM message_chunks WHERE chunk_id = ?', (next_id,))
+    await db.execute('UPDATE message_chunks SET message_id = ? WHERE message_id = ?', (next_id, message_id))
+    await db.execute('UPDATE messages SET message_id = ? WHERE message_id = ? AND guild_id = ?', (next_id, message_id, guild_id))
+    return next_id
+
+def apply_vector_updates(guild_id: str, updates: List[Tuple[str, ...]]) -> None:
+    # Replayed in order once the batch is committed, so the index never runs ahead of the database
+    for update in updates:
+        if update[0] == 'upsert':
+            vectors.upsert_many(guild_id, [update[1:]])
+        elif update[0] == 'delete':
+            vectors.remove(guild_id, update[1])
+        elif update[0] == 'rename':
+            vectors.rename(guild_id, update[1], update[2])
+        elif update[0] == 'clear':
+            vectors.clear(guild_id)
+
+async def apply_write_batch(guild_id: str, ops: List[WriteOp]) -> None:
+    inserted = False
+    vector_updates = []
+    async with pool.connection(get_db_path(guild_id)) as db:
+        try:
+            for op in ops:
+                if op.kind == 'upsert':
+                    row_id = await upsert_row(db, guild_id, op.params)
+                    vector_updates.append(('upsert', row_id, op.params[2]))
+                    inserted = True
+                elif op.kind == 'delete':
+                    next_id = await delete_row(db, guild_id, op.params[0])
+                    vector_updates.append(('rename', op.params[0], next_id) if next_id else ('delete', op.params[0]))
+                elif op.kind == 'clear':
+                    await db.execute('DELETE FROM messages WHERE guild_id = ?', (guild_id,))
+                    # Otherwise the next sync would refill the history from the old cursors
+                    await db.execute('DELETE FROM sync_cursors WHERE guild_id = ?', (guild_id,))
+                    await db.execute('DELETE FROM history_summaries WHERE guild_id = ?', (guild_id,))
+                    vector_updates.append(('clear',))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            # The cache already reflects these writes, so it can no longer be trusted for this guild
+            invalidate_cache(guild_id)
+            raise
+
+        # The writes are committed, so their callers hear about it now; what follows is bookkeeping
+        for op in ops:
+            if not op.future.done():
+                op.future.set_result(None)
+        try:
+            apply_vector_updates(guild_id, vector_updates)
+        except Exception as e:
+            print(f"Error updating the vector index for guild {guild_id}: {e}")
+        if inserted:
+            summary_pending.add(guild_id)
+            try:
+                if ARCHIVE_MAX_AGE_DAYS or await count_rows(db, guild_id) > MAX_CONTEXT_SIZE:
+                    trim_pending.add(guild_id)
+            except Exception as e:
+                print(f"Error counting history rows for guild {guild_id}: {e}")
+
+write_queue = HistoryWriteQueue(apply_write_batch)
+
+async def count_rows(db: Any, guild_id: str) -> int:
+    async with db.execute('SELECT row_count FROM guild_stats WHERE guild_id = ?', (guild_id,)) as cursor:
+        row = await cursor.fetchone()
+    return row[0] if row else 0
+
+async def get_history_count(guild_id: str) -> int:
+    await write_queue.flush(guild_id)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        return await count_rows(db, guild_id)
+
+async def run_maintenance() -> None:
+    for guild_id in list(trim_pending):
+        trim_pending.discard(guild_id)
+        try:
+            await maintain_context_size_limit(guild_id)
+        except Exception as e:
+            print(f"Error trimming history for guild {guild_id}: {e}")
+
+async def _maintenance_loop() -> None:
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        await run_maintenance()
+
+def is_idle(guild_id: str) -> bool:
+    return time.monotonic() - last_activity.get(guild_id, 0) >= SUMMARY_IDLE_SECONDS
+
+def is_file_idle(db_path: str) -> bool:
+    # In the shared layout one file holds many guilds, and all of them must be quiet
+    return all(is_idle(guild_id) for guild_id in list(last_activity) if get_db_path(guild_id) == db_path)
+
+async def run_compaction() -> None:
+    for guild_id in list(summary_pending):
+        if not is_idle(guild_id):
+            continue
+        summary_pending.discard(guild_id)
+        try:
+            await compact_history(guild_id)
+        except Exception as e:
+            print(f"Error summarizing history for guild {guild_id}: {e}")
+
+async def _summary_loop() -> None:
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        await run_compaction()
+
+def start(history_summarizer: Optional[Summarizer] = None) -> None:
+    global maintenance_task, summary_task, summarizer
+    pool.start()
+    if maintenance_task is None or maintenance_task.done():
+        maintenance_task = asyncio.get_running_loop().create_task(_maintenance_loop())
+    if history_summarizer is not None:
+        summarizer = history_summarizer
+        if summary_task is None or summary_task.done():
+            summary_task = asyncio.get_running_loop().create_task(_summary_loop())
+
+async def close() -> None:
+    global maintenance_task, summary_task
+    if maintenance_task:
+        maintenance_task.cancel()
+        maintenance_task = None
+    if summary_task:
+        summary_task.cancel()
+        summary_task = None
+    for task in list(sync_tasks.values()) + list(vector_builds.values()):
+        task.cancel()
+    await write_queue.flush()
+    await pool.close_all()
+    vectors.close()
 
 async def get_guild_history(guild_id: str) -> List[Dict[str, Any]]:
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    if not os.path.exists(db_path):
-        await initialize_db(db_path)
-    async with aiosqlite.connect(db_path) as db:
-        async with db.execute('SELECT message_id, role, content, timestamp FROM messages ORDER BY timestamp') as cursor:
+    await write_queue.flush(guild_id)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        async with db.execute('SELECT message_id, role, content, timestamp FROM messages WHERE guild_id = ? ORDER BY sort_key, id', (guild_id,)) as cursor:
             return [{"message_id": row[0], "content": {"role": row[1], "parts": [row[2]]}, "timestamp": row[3]} for row in await cursor.fetchall()]
 
-async def update_guild_history(guild_id: str, message: Dict[str, Any], message_id: str, timestamp: Optional[datetime] = None) -> None:
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    if not os.path.exists(db_path):
-        await initialize_db(db_path)
-    async with aiosqlite.connect(db_path) as db:
-        # Check if the message already exists
-        async with db.execute('SELECT id, timestamp FROM messages WHERE message_id = ?', (message_id,)) as cursor:
-            existing_message = await cursor.fetchone()
-        
-        if existing_message:
-            # If the message exists, update its content but keep the original timestamp
-            await db.execute('''
-                UPDATE messages
-                SET role = ?, content = ?
-                WHERE message_id = ?
-            ''', (message['role'], message['parts'][0], message_id))
-        else:
-            # If the message doesn't exist, insert it as a new entry
-            if timestamp is None:
-                timestamp = datetime.now()
-            await db.execute('''
-                INSERT INTO messages (message_id, role, content, timestamp)
-                VALUES (?, ?, ?, ?)
-            ''', (message_id, message['role'], message['parts'][0], timestamp))
-        
-        await db.commit()
+async def get_recent_history(guild_id: str, max_chars: Optional[int] = None, max_tokens: Optional[int] = None, max_turns: Optional[int] = None, channel_id: Optional[int] = None, after_sort_key: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Returns the newest turns that fit within the given budgets, oldest first,
+    from the whole guild or, when channel_id is given, from that channel only,
+    and none at or before `after_sort_key` when it is given.
+    Active guilds are answered from the in-memory cache; otherwise rows are
+    read backwards through the sort_key index a page at a time and reading
+    stops as soon as the next turn would exceed the budget.
+    """
+    if max_tokens is not None:
+        max_chars = min(max_chars, max_tokens * CHARS_PER_TOKEN) if max_chars is not None else max_tokens * CHARS_PER_TOKEN
 
-    # Check and maintain the context size limit
-    await maintain_context_size_limit(guild_id)
+    key = scope_key(guild_id, channel_id)
+    turns = cache.tail(key, max_chars, max_turns, after_sort_key)
+    if turns is not None:
+        return turns
+    if cache.loaded(key):
+        # The cached window is already as large as it gets; refilling it would not cover this budget either
+        return await read_recent_history(guild_id, max_chars, max_turns, channel_id, after_sort_key)
 
-async def edit_guild_history(guild_id: str, message: Dict[str, Any], message_id: str) -> None:
-    await update_guild_history(guild_id, message, message_id)
+    version = cache.version(key)
+    where, params = scope_filter(guild_id, channel_id)
+    await write_queue.flush(guild_id)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        async with db.execute(f'''
+            SELECT message_id, role, content, timestamp, sort_key,
+                (SELECT group_concat(chunk_id) FROM message_chunks WHERE message_chunks.message_id = messages.message_id)
+            FROM messages WHERE {where} ORDER BY sort_key DESC, id DESC LIMIT ?
+        ''', (*params, cache.max_turns)) as cursor:
+            rows = [(*row[:5], row[5].split(',') if row[5] else ()) for row in await cursor.fetchall()]
+    rows.reverse()
+    cache.fill(key, rows, len(rows) < cache.max_turns, version)
 
-async def remove_message_from_history(guild_id: str, message_id: str) -> None:
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    if os.path.exists(db_path):
-        async with aiosqlite.connect(db_path) as db:
-            await db.execute('DELETE FROM messages WHERE message_id = ?', (message_id,))
-            await db.commit()
+    turns = cache.tail(key, max_chars, max_turns, after_sort_key)
+    if turns is not None:
+        return turns
+    return await read_recent_history(guild_id, max_chars, max_turns, channel_id, after_sort_key)
 
-async def clear_guild_history(guild_id: str) -> None:
+async def read_recent_history(guild_id: str, max_chars: Optional[int] = None, max_turns: Optional[int] = None, channel_id: Optional[int] = None, after_sort_key: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Budgets larger than the cached window are served straight from the database
+    where, scope_params = scope_filter(guild_id, channel_id)
+    if after_sort_key is not None:
+        where += ' AND sort_key > ?'
+        scope_params = (*scope_params, after_sort_key)
+    await write_queue.flush(guild_id)
+    turns = []
+    used_chars = 0
+    cursor_key = None
+    async with pool.connection(get_db_path(guild_id)) as db:
+        while True:
+            page_size = HISTORY_PAGE_SIZE if max_turns is None else min(HISTORY_PAGE_SIZE, max_turns - len(turns))
+            if cursor_key is None:
+                query = f'SELECT message_id, role, content, timestamp, sort_key, id FROM messages WHERE {where} ORDER BY sort_key DESC, id DESC LIMIT ?'
+                params = (*scope_params, page_size)
+            else:
+                query = f'SELECT message_id, role, content, timestamp, sort_key, id FROM messages WHERE {where} AND (sort_key, id) < (?, ?) ORDER BY sort_key DESC, id DESC LIMIT ?'
+                params = (*scope_params, *cursor_key, page_size)
+            async with db.execute(query, params) as cursor:
+                rows = await cursor.fetchall()
+
+            for message_id, role, content, timestamp, sort_key, row_id in rows:
+                used_chars += len(content or '')
+                if max_chars is not None and used_chars > max_chars:
+                    turns.reverse()
+                    return turns
+                turns.append({"message_id": message_id, "content": {"role": role, "parts": [content]}, "timestamp": timestamp})
+
+            if len(rows) < page_size or (max_turns is not None and len(turns) >= max_turns):
+                break
+            cursor_key = (rows[-1][4], rows[-1][5])
+
+    turns.reverse()
+    return turns
+
+def build_match_query(text: str) -> Optional[str]:
+    # Any of the longer words may match; each is quoted so user text can't inject FTS5 syntax
+    words = {word.lower() for word in re.findall(r'\w{3,}', text)}
+    terms = sorted(words, key=len, reverse=True)[:SEARCH_MAX_TERMS]
+    if not terms:
+        return None
+    return ' OR '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+async def search_history(guild_id: str, text: str, limit: int = 5, before_sort_key: Optional[int] = None, channel_id: Optional[int] = None, mode: str = 'text') -> List[Dict[str, Any]]:
+    """
+    Returns up to `limit` turns that best match `text` in the full-text index,
+    or with mode='vector' the most similar turns in the vector index, oldest
+    first, optionally only turns older than `before_sort_key`.
+    """
+    if mode == 'vector':
+        return await search_similar_history(guild_id, text, limit, before_sort_key, channel_id)
+
+    match = build_match_query(text)
+    if match is None or limit <= 0:
+        return []
+
+    where, params = scope_filter(guild_id, channel_id)
+    if before_sort_key is not None:
+        where += ' AND sort_key < ?'
+        params = (*params, before_sort_key)
+
+    await write_queue.flush(guild_id)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        try:
+            async with db.execute(f'''
+                SELECT message_id, role, content, timestamp, sort_key FROM (
+                    SELECT messages.*, bm25(messages_fts) AS rank FROM messages_fts
+                    JOIN messages ON messages.id = messages_fts.rowid
+                    WHERE messages_fts MATCH ?
+                ) WHERE {where} ORDER BY rank LIMIT ?
+            ''', (match, *params, limit)) as cursor:
+                rows = await cursor.fetchall()
+        except Exception as e:
+            # Built without FTS5, so the index was never created
+            print(f"Error searching history for guild {guild_id}: {e}")
+            return []
+
+    rows.sort(key=lambda row: row[4])
+    return [{"message_id": row[0], "content": {"role": row[1], "parts": [row[2]]}, "timestamp": row[3]} for row in rows]
+
+async def search_similar_history(guild_id: str, text: str, limit: int = 5, before_sort_key: Optional[int] = None, channel_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    if limit <= 0:
+        return []
+    if vectors.get(guild_id) is None:
+        # The first similarity search for a guild indexes its history in the background
+        schedule_vector_build(guild_id)
+        return []
+
+    await write_queue.flush(guild_id)
+    candidates = limit * VECTOR_OVERFETCH if channel_id is not None else limit
+    hits = vectors.search(guild_id, text, candidates, before_sort_key)
+    if not hits:
+        return []
 
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    if os.path.exists(db_path):
-        async with aiosqlite.connect(db_path) as db:
-            await db.execute('DELETE FROM messages')
+    ranks = {str(message_id): rank for rank, (message_id, _) in enumerate(hits)}
+    where, params = scope_filter(guild_id, channel_id)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        async with db.execute(f'''
+            SELECT message_id, role, content, timestamp, sort_key FROM messages
+            WHERE {where} AND message_id IN ({','.join('?' * len(ranks))})
+        ''', (*params, *ranks)) as cursor:
+            rows = await cursor.fetchall()
+
+    rows = sorted(rows, key=lambda row: ranks[row[0]])[:limit]
+    rows.sort(key=lambda row: row[4])
+    return [{"message_id": row[0], "content": {"role": row[1], "parts": [row[2]]}, "timestamp": row[3]} for row in rows]
+
+async def build_vector_index(guild_id: str) -> None:
+    """Embeds every stored turn of a guild; later writes keep the index current."""
+    await write_queue.flush(guild_id)
+    vectors.create(guild_id)
+    after = (-1, 0)
+    while True:
+        # One page per connection hold, so replies aren't kept waiting behind the whole build.
+        # Paged along the (guild_id, sort_key) index, so each page is a range seek rather than a scan and sort
+        async with pool.connection(get_db_path(guild_id)) as db:
+            async with db.execute('SELECT sort_key, id, message_id, content FROM messages WHERE guild_id = ? AND (sort_key, id) > (?, ?) ORDER BY sort_key, id LIMIT ?', (guild_id, *after, HISTORY_PAGE_SIZE)) as cursor:
+                rows = await cursor.fetchall()
+            vectors.upsert_many(guild_id, [(message_id, content) for _, _, message_id, content in rows])
+        if len(rows) < HISTORY_PAGE_SIZE:
+            return
+        after = (rows[-1][0], rows[-1][1])
+
+def schedule_vector_build(guild_id: str) -> Optional[asyncio.Task]:
+    task = vector_builds.get(guild_id)
+    if task is not None and not task.done():
+        return None
+
+    async def run() -> None:
+        try:
+            await build_vector_index(guild_id)
+        except Exception as e:
+            print(f"Error building vector index for guild {guild_id}: {e}")
+        finally:
+            vector_builds.pop(guild_id, None)
+
+    task = asyncio.get_running_loop().create_task(run())
+    vector_builds[guild_id] = task
+    return task
+
+async def get_history_summaries(guild_id: str, before_sort_key: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Returns the guild's summaries that start before `before_sort_key`, oldest first."""
+    where, params = 'guild_id = ?', (guild_id,)
+    if before_sort_key is not None:
+        where += ' AND first_sort_key < ?'
+        params = (*params, before_sort_key)
+    async with pool.connection(get_db_path(guild_id)) as db:
+        async with db.execute(f'SELECT content, first_sort_key, last_sort_key, turn_count FROM history_summaries WHERE {where} ORDER BY first_sort_key', params) as cursor:
+            return [{"content": row[0], "first_sort_key": row[1], "last_sort_key": row[2], "turn_count": row[3]} for row in await cursor.fetchall()]
+
+async def compact_history(guild_id: str) -> None:
+    """
+    Folds spans of SUMMARY_SPAN_TURNS turns, oldest first, into summary records
+    until only the newest SUMMARY_KEEP_RECENT unsummarized turns remain. Stops
+    as soon as the guild becomes active again, since a summarizer call can take
+    a while and the remaining spans will be picked up on the next idle pass.
+    """
+    while summarizer is not None and is_idle(guild_id):
+        await write_queue.flush(guild_id)
+        async with pool.connection(get_db_path(guild_id)) as db:
+            async with db.execute('SELECT MAX(last_sort_key) FROM history_summaries WHERE guild_id = ?', (guild_id,)) as cursor:
+                summarized_until = (await cursor.fetchone())[0] or 0
+            async with db.execute('SELECT content FROM history_summaries WHERE guild_id = ? ORDER BY last_sort_key DESC LIMIT 1', (guild_id,)) as cursor:
+                previous = await cursor.fetchone()
+            async with db.execute('SELECT message_id, role, content, timestamp, sort_key FROM messages WHERE guild_id = ? AND sort_key > ? ORDER BY sort_key, id LIMIT ?',
+                                  (guild_id, summarized_until, SUMMARY_SPAN_TURNS + SUMMARY_KEEP_RECENT)) as cursor:
+                rows = await cursor.fetchall()
+        if len(rows) < SUMMARY_SPAN_TURNS + SUMMARY_KEEP_RECENT:
+            return
+
+        span = rows[:SUMMARY_SPAN_TURNS]
+        turns = [{"message_id": row[0], "content": {"role": row[1], "parts": [row[2] or '']}, "timestamp": row[3]} for row in span]
+        # The summarizer runs outside the connection so writers are not held up by it
+        content = await summarizer.summarize(guild_id, turns, previous[0] if previous else None)
+        if not content:
+            return
+
+        async with pool.connection(get_db_path(guild_id)) as db:
+            # Skipped if the history was cleared while the summary was being written
+            cursor = await db.execute('''
+                INSERT INTO history_summaries (guild_id, level, first_sort_key, last_sort_key, turn_count, content)
+                SELECT ?, 0, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE message_id = ? AND guild_id = ?)
+            ''', (guild_id, span[0][4], span[-1][4], len(span), content, rows[-1][0], guild_id))
             await db.commit()
+        if not cursor.rowcount:
+            return
+        await merge_summaries(guild_id)
+
+async def merge_summaries(guild_id: str) -> None:
+    # Keeps the summary tier bounded by folding the oldest records into one at the next level
+    async with pool.connection(get_db_path(guild_id)) as db:
+        async with db.execute('SELECT id, level, first_sort_key, last_sort_key, turn_count, content FROM history_summaries WHERE guild_id = ? ORDER BY first_sort_key', (guild_id,)) as cursor:
+            records = await cursor.fetchall()
+    if len(records) <= SUMMARY_MAX_RECORDS:
+        return
+
+    oldest = records[:SUMMARY_MERGE_COUNT]
+    turns = [{"message_id": str(record[0]), "content": {"role": "summary", "parts": [record[5]]}, "timestamp": None} for record in oldest]
+    content = await summarizer.summarize(guild_id, turns)
+    if not content:
+        return
+
+    async with pool.connection(get_db_path(guild_id)) as db:
+        cursor = await db.execute(f'DELETE FROM history_summaries WHERE id IN ({",".join("?" * len(oldest))})', [record[0] for record in oldest])
+        if cursor.rowcount != len(oldest):
+            await db.rollback()
+            return
+        await db.execute('INSERT INTO history_summaries (guild_id, level, first_sort_key, last_sort_key, turn_count, content) VALUES (?, ?, ?, ?, ?, ?)',
+                         (guild_id, max(record[1] for record in oldest) + 1, oldest[0][2], oldest[-1][3], sum(record[4] for record in oldest), content))
+        await db.commit()
+
+async def update_guild_history(guild_id: str, message: Dict[str, Any], message_id: str, timestamp: Optional[datetime] = None, wait: bool = True, channel_id: Optional[int] = None, chunk_ids: Sequence[str] = ()) -> None:
+    """
+    Stores or updates one turn. A response sent as several Discord messages is
+    stored once under its first message id, with the other ids as chunk_ids.
+    """
+    last_activity[guild_id] = time.monotonic()
+    if timestamp is None:
+        timestamp = datetime.now(timezone.utc)
+    params = (message_id, message['role'], message['parts'][0], timestamp, sort_key_for(message_id, timestamp), channel_id, tuple(chunk_ids))
+    cache.upsert(guild_id, message_id, message['role'], message['parts'][0], str(timestamp), params[4], chunk_ids)
+    if channel_id is not None:
+        cache.upsert(scope_key(guild_id, channel_id), message_id, message['role'], message['parts'][0], str(timestamp), params[4], chunk_ids)
+    future = write_queue.submit(guild_id, 'upsert', params, wait)
+    if wait:
+        # Shielded so a cancelled caller doesn't cancel a future that flushes also wait on
+        await asyncio.shield(future)
+
+async def edit_guild_history(guild_id: str, message: Dict[str, Any], message_id: str, channel_id: Optional[int] = None) -> None:
+    await update_guild_history(guild_id, message, message_id, channel_id=channel_id)
+
+async def remove_message_from_history(guild_id: str, message_id: str, wait: bool = True, channel_id: Optional[int] = None) -> None:
+    if os.path.exists(get_db_path(guild_id)):
+        cache.remove(guild_id, message_id)
+        if channel_id is not None:
+            cache.remove(scope_key(guild_id, channel_id), message_id)
+        else:
+            cache.invalidate_prefix(f'{guild_id}/')
+        future = write_queue.submit(guild_id, 'delete', (message_id,), wait)
+        if wait:
+            await asyncio.shield(future)
 
-async def maintain_context_size_limit(guild_id: str) -> None:
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    async with aiosqlite.connect(db_path) as db:
-        # Get the current number of rows
-        async with db.execute('SELECT COUNT(*) FROM messages') as cursor:
-            count = (await cursor.fetchone())[0]
-        
+async def clear_guild_history(guild_id: str) -> None:
+    if os.path.exists(get_db_path(guild_id)):
+        cache.clear(guild_id)
+        cache.invalidate_prefix(f'{guild_id}/')
+        await asyncio.shield(write_queue.submit(guild_id, 'clear', ()))
+        # Forgetting the history includes what was moved to cold storage
+        await asyncio.to_thread(GuildArchive(guild_id).clear)
+
+async def maintain_context_size_limit(guild_id: str) -> int:
+    """
+    Removes the oldest rows once a guild has more than MAX_CONTEXT_SIZE of
+    them, along with rows older than ARCHIVE_MAX_AGE_DAYS, writing them to the
+    guild's archive first unless archiving is disabled. Returns the number of
+    rows removed from the live database.
+    """
+    async with pool.connection(get_db_path(guild_id)) as db:
+        count = await count_rows(db, guild_id)
+        cutoff = None
         if count > MAX_CONTEXT_SIZE:
-            # Calculate how many rows to delete
-            rows_to_delete = count - MAX_CONTEXT_SIZE
-            
-            # Delete the oldest rows
-            await db.execute('''
-                DELETE FROM messages
-                WHERE id IN (
-                    SELECT id FROM messages
-                    ORDER BY timestamp ASC
-                    LIMIT ?
-                )
-            ''', (rows_to_delete,))
-            
+            # The oldest row to keep; everything before it goes in one index range
+            async with db.execute('SELECT sort_key, id FROM messages WHERE guild_id = ? ORDER BY sort_key, id LIMIT 1 OFFSET ?', (guild_id, count - CONTEXT_LOW_WATER_MARK)) as cursor:
+                cutoff = await cursor.fetchone()
+        if ARCHIVE_MAX_AGE_DAYS:
+            age_cutoff = (snowflake_from_datetime(datetime.now(timezone.utc) - timedelta(days=ARCHIVE_MAX_AGE_DAYS)), 0)
+            async with db.execute('SELECT 1 FROM messages WHERE guild_id = ? AND sort_key < ? LIMIT 1', (guild_id, age_cutoff[0])) as cursor:
+                if await cursor.fetchone() and (cutoff is None or age_cutoff > tuple(cutoff)):
+                    cutoff = age_cutoff
+    if cutoff is None:
+        return 0
+
+    if ARCHIVE_ENABLED:
+        # Only the rows that made it into the archive are deleted; one a sync or restore slipped in
+        # below the cutoff meanwhile stays live until the next trim
+        archived = await archive_rows(guild_id, tuple(cutoff))
+        removed = 0
+        async with pool.connection(get_db_path(guild_id)) as db:
+            for start in range(0, len(archived), HISTORY_PAGE_SIZE):
+                page = archived[start:start + HISTORY_PAGE_SIZE]
+                cursor = await db.execute(f'DELETE FROM messages WHERE id IN ({",".join("?" * len(page))})', page)
+                removed += cursor.rowcount
+            await db.commit()
+    else:
+        async with pool.connection(get_db_path(guild_id)) as db:
+            cursor = await db.execute('DELETE FROM messages WHERE guild_id = ? AND (sort_key, id) < (?, ?)', (guild_id, *cutoff))
             await db.commit()
+            removed = cursor.rowcount
+    cache.trim(guild_id, count - removed)
+    # A quiet channel's cached window can reach back past the rows just deleted
+    cache.invalidate_prefix(f'{guild_id}/')
+    vectors.remove_before(guild_id, cutoff[0])
+    await vacuum_database(guild_id)
+    return removed
+
+async def archive_rows(guild_id: str, cutoff: Tuple[int, int]) -> List[int]:
+    """
+    Streams the rows before `cutoff` into a new archive segment, a page at a
+    time, and returns the ids of the rows it wrote once the segment is committed.
+    """
+    writer = await asyncio.to_thread(GuildArchive(guild_id).open_segment)
+    archived = []
+    try:
+        after = None
+        while True:
+            where, params = 'guild_id = ? AND (sort_key, id) < (?, ?)', (guild_id, *cutoff)
+            if after is not None:
+                where += ' AND (sort_key, id) > (?, ?)'
+                params = (*params, *after)
+            async with pool.connection(get_db_path(guild_id)) as db:
+                async with db.execute(f'''
+                    SELECT message_id, role, content, timestamp, sort_key, channel_id, id,
+                        (SELECT group_concat(chunk_id) FROM message_chunks WHERE message_chunks.message_id = messages.message_id)
+                    FROM messages WHERE {where} ORDER BY sort_key, id LIMIT ?
+                ''', (*params, ARCHIVE_PAGE_ROWS)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                break
+            await asyncio.to_thread(writer.write, [
+                {"message_id": row[0], "role": row[1], "content": row[2], "timestamp": row[3], "sort_key": row[4],
+                 "channel_id": row[5], "chunk_ids": row[7].split(',') if row[7] else []}
+                for row in rows
+            ])
+            archived.extend(row[6] for row in rows)
+            after = (rows[-1][4], rows[-1][6])
+        await asyncio.to_thread(writer.commit)
+    except BaseException:
+        await asyncio.to_thread(writer.abort)
+        raise
+    return archived
+
+async def vacuum_database(guild_id: str) -> None:
+    """Hands the pages freed by a trim back to the filesystem."""
+    db_path = get_db_path(guild_id)
+    async with pool.connection(db_path) as db:
+        async with db.execute('PRAGMA freelist_count') as cursor:
+            free_pages = (await cursor.fetchone())[0]
+        if free_pages < VACUUM_MIN_FREE_PAGES:
+            return
+        async with db.execute('PRAGMA auto_vacuum') as cursor:
+            incremental = (await cursor.fetchone())[0] == 2
+        if not incremental:
+            # Files created before incremental auto-vacuum need one full VACUUM to switch, which
+            # rewrites the whole file and blocks every guild on it, so it waits until they are all quiet
+            if is_file_idle(db_path):
+                await db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                await db.execute('VACUUM')
+            return
+
+    # A step at a time, so writers for this file are not held up behind the whole truncation
+    while free_pages > 0:
+        async with pool.connection(db_path) as db:
+            async with db.execute(f'PRAGMA incremental_vacuum({VACUUM_STEP_PAGES})') as cursor:
+                await cursor.fetchall()
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                remaining = (await cursor.fetchone())[0]
+        if remaining >= free_pages:
+            break
+        free_pages = remaining
+
+async def restore_history(guild_id: str, since_sort_key: Optional[int] = None) -> int:
+    """
+    Moves archived segments back into the live database, optionally only those
+    ending at or after `since_sort_key`. Restored rows count towards
+    MAX_CONTEXT_SIZE again, so the maintenance task will archive the oldest of
+    them once more if the guild ends up over the limit. Returns the number of
+    rows restored.
+    """
+    await write_queue.flush(guild_id)
+    archive = GuildArchive(guild_id)
+    restored = 0
+    for segment in await asyncio.to_thread(archive.segments):
+        if since_sort_key is not None and segment["last_sort_key"] < since_sort_key:
+            continue
+        rows = await asyncio.to_thread(archive.load_segment, segment)
+        async with pool.connection(get_db_path(guild_id)) as db:
+            try:
+                cursor = await db.executemany('''
+                    INSERT OR IGNORE INTO messages (message_id, role, content, timestamp, sort_key, channel_id, guild_id)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', [(row["message_id"], row["role"], row["content"], row["timestamp"], row["sort_key"], row["channel_id"], guild_id) for row in rows])
+                restored += cursor.rowcount
+                await db.executemany('INSERT OR IGNORE INTO message_chunks (chunk_id, message_id) VALUES (?, ?)',
+                                     [(chunk_id, row["message_id"]) for row in rows for chunk_id in row["chunk_ids"]])
+                await db.commit()
+            except Exception:
+                await db.rollback()
+                raise
+        vectors.upsert_many(guild_id, [(row["message_id"], row["content"]) for row in rows])
+        await asyncio.to_thread(archive.remove_segment, segment)
+
+    if restored:
+        invalidate_cache(guild_id)
+        if await get_history_count(guild_id) > MAX_CONTEXT_SIZE:
+            trim_pending.add(guild_id)
+    return restored
+
+async def get_sync_cursor(db: Any, guild_id: str, channel_id: int) -> int:
+    async with db.execute('SELECT last_message_id FROM sync_cursors WHERE channel_id = ?', (channel_id,)) as cursor:
+        row = await cursor.fetchone()
+    # Live writes don't move the cursor, so anything the channel already stored past it is not fetched again
+    async with db.execute('SELECT MAX(sort_key) FROM messages WHERE guild_id = ? AND channel_id = ?', (guild_id, channel_id)) as cursor:
+        newest_stored = (await cursor.fetchone())[0]
+    if row or newest_stored is not None:
+        return max(row[0] if row else 0, newest_stored or 0)
+    # Channels synced before cursors or channel ids existed resume from the newest stored message
+    async with db.execute('SELECT MAX(sort_key) FROM messages WHERE guild_id = ?', (guild_id,)) as cursor:
+        return (await cursor.fetchone())[0] or 0
 
 async def sync_bot_user_messages(guild_id: str, channel_id: int, bot: Any) -> None:
     channel = bot.get_channel(channel_id)
@@ -103,56 +691,80 @@ async def sync_bot_user_messages(guild_id: str, channel_id: int, bot: Any) -> No
         print(f"Couldn't find channel with id {channel_id}")
         return
 
-    db_path = f'memories/{guild_id}_histories.sqlite'
-    if not os.path.exists(db_path):
-        await initialize_db(db_path)
+    await write_queue.flush(guild_id)
 
-    async with aiosqlite.connect(db_path) as db:
+    async with pool.connection(get_db_path(guild_id)) as db:
         # Check if the database is empty (indicating a recent clear)
-        async with db.execute('SELECT COUNT(*) FROM messages') as cursor:
-            count = (await cursor.fetchone())[0]
-        
-        if count == 0:
+        if await count_rows(db, guild_id) == 0:
             # If the database is empty, we don't want to repopulate it with old messages
             return
 
-        # Get the timestamp of the most recent message in the database
-        async with db.execute('SELECT MAX(timestamp) FROM messages') as cursor:
-            last_timestamp = await cursor.fetchone()
-        
-        last_timestamp = last_timestamp[0] if last_timestamp[0] else "1970-01-01T00:00:00"
-        last_timestamp = datetime.fromisoformat(last_timestamp)
-
-        # Fetch messages from Discord that are newer than the most recent message in the database
-        messages = [
-            message async for message in channel.history(limit=100, after=last_timestamp)
-            if message.author == bot.user or (message.mentions and bot.user in message.mentions)
-        ]
-        messages.reverse()  # Process in chronological order
-
-        for message in messages:
-            # Check if the message exists in the database
-            async with db.execute('SELECT id FROM messages WHERE message_id = ?', (str(message.id),)) as cursor:
-                existing_message = await cursor.fetchone()
-
-            if existing_message:
-                # Update existing message
-                await db.execute('''
-                    UPDATE messages
-                    SET content = ?, timestamp = ?
-                    WHERE message_id = ?
-                ''', (message.content, message.created_at, str(message.id)))
-            else:
-                # Insert new message
-                await db.execute('''
-                    INSERT INTO messages (message_id, role, content, timestamp)
-                    VALUES (?, ?, ?, ?)
-                ''', (str(message.id), 'user' if not message.author.bot else 'assistant', message.content, message.created_at))
+        last_seen_id = await get_sync_cursor(db, guild_id, channel_id)
 
-        await db.commit()
+    # Fetch messages from Discord that are newer than the channel's cursor, oldest first.
+    # discord.py pages through the results 100 at a time; this happens outside the
+    # connection so other writers for this guild are not held up by the REST calls.
+    rows = []
+    newest_seen_id = last_seen_id
+    async for message in channel.history(limit=SYNC_MAX_MESSAGES, after=discord.Object(id=last_seen_id), oldest_first=True):
+        newest_seen_id = max(newest_seen_id, message.id)
+        if message.author == bot.user or (message.mentions and bot.user in message.mentions):
+            # Formatted like the live writes in main.py, so a synced row reads the same as one stored as it arrived
+            content = message.content if message.author.bot else f"{message.author.display_name}: {message.content}"
+            rows.append((str(message.id), 'user' if not message.author.bot else 'assistant', content, message.created_at, message.id, channel_id, guild_id))
+
+    if newest_seen_id == last_seen_id:
+        return
+
+    async with pool.connection(get_db_path(guild_id)) as db:
+        try:
+            # Chunks of a stored split response are skipped, and rows already stored are left as they are
+            await db.executemany('''
+                INSERT INTO messages (message_id, role, content, timestamp, sort_key, channel_id, guild_id)
+                SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS (SELECT 1 FROM message_chunks WHERE chunk_id = ?1)
+                ON CONFLICT(message_id) DO NOTHING
+            ''', rows)
+            await db.execute('''
+                INSERT INTO sync_cursors (channel_id, last_message_id, guild_id) VALUES (?, ?, ?)
+                ON CONFLICT(channel_id) DO UPDATE SET last_message_id = excluded.last_message_id
+            ''', (channel_id, newest_seen_id, guild_id))
+            await db.commit()
+
+            if rows and vectors.get(guild_id) is not None:
+                # Re-read what was stored rather than embedding skipped chunks or a split response's first part
+                async with db.execute('SELECT message_id, content FROM messages WHERE guild_id = ? AND channel_id = ? AND sort_key > ?', (guild_id, channel_id, last_seen_id)) as cursor:
+                    vectors.upsert_many(guild_id, await cursor.fetchall())
+        except Exception:
+            await db.rollback()
+            raise
+        finally:
+            # Synced rows are rare enough that reloading the cache is simpler than mirroring the rules above
+            if rows:
+                invalidate_cache(guild_id)
+
+        # Trimming, if needed, is left to the maintenance task
+        if await count_rows(db, guild_id) > MAX_CONTEXT_SIZE:
+            trim_pending.add(guild_id)
+
+def schedule_sync(guild_id: str, channel_id: int, bot: Any) -> Optional[asyncio.Task]:
+    """Starts a background sync of one channel unless one is already running."""
+    key = (guild_id, channel_id)
+    task = sync_tasks.get(key)
+    if task is not None and not task.done():
+        return None
+
+    async def run() -> None:
+        try:
+            async with sync_limit:
+                await sync_bot_user_messages(guild_id, channel_id, bot)
+        except Exception as e:
+            print(f"Error syncing channel {channel_id} in guild {guild_id}: {e}")
+        finally:
+            sync_tasks.pop(key, None)
 
-    # Maintain context size limit after syncing
-    await maintain_context_size_limit(guild_id)
+    task = asyncio.get_running_loop().create_task(run())
+    sync_tasks[key] = task
+    return task
 
 # Ensure the memories folder exists
 if not os.path.exists('memories'):
@@ -0,0 +1,144 @@
+import os
+import gzip
+import json
+import asyncio
+import argparse
+import shutil
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional
+
+ARCHIVE_DIR = 'memories/archive'
+# Rows trimmed from the live database are written here first; set HISTORY_ARCHIVE=0 to just delete them
+ARCHIVE_ENABLED = os.getenv('HISTORY_ARCHIVE', '1') != '0'
+ARCHIVE_MAX_AGE_DAYS = int(os.getenv('ARCHIVE_MAX_AGE_DAYS', '0'))  # Also archive rows older than this; 0 disables
+ARCHIVE_PAGE_ROWS = 1000
+
+
+class SegmentWriter:
+    """
+    Streams rows into a new gzip-compressed NDJSON segment. The segment only
+    becomes visible in the index once `commit` has renamed it into place.
+    """
+
+    def __init__(self, archive: 'GuildArchive'):
+        self.archive = archive
+        os.makedirs(archive.directory, exist_ok=True)
+        self.temp_path = os.path.join(archive.directory, f'.segment-{os.getpid()}-{id(self)}.tmp')
+        self.file = gzip.open(self.temp_path, 'wt', encoding='utf-8')
+        self.first_sort_key: Optional[int] = None
+        self.last_sort_key: Optional[int] = None
+        self.count = 0
+
+    def write(self, rows: List[Dict[str, Any]]) -> None:
+        for row in rows:
+            self.file.write(json.dumps(row, ensure_ascii=False, default=str) + '\n')
+            if self.first_sort_key is None:
+                self.first_sort_key = row['sort_key']
+            self.last_sort_key = row['sort_key']
+            self.count += 1
+
+    def commit(self) -> Optional[Dict[str, Any]]:
+        self.file.close()
+        if not self.count:
+            os.remove(self.temp_path)
+            return None
+        with open(self.temp_path, 'rb') as f:
+            os.fsync(f.fileno())
+        name = f'{self.first_sort_key}-{self.last_sort_key}.ndjson.gz'
+        os.replace(self.temp_path, os.path.join(self.archive.directory, name))
+        entry = {
+            "file": name,
+            "first_sort_key": self.first_sort_key,
+            "last_sort_key": self.last_sort_key,
+            "count": self.count,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        }
+        self.archive.add(entry)
+        return entry
+
+    def abort(self) -> None:
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class GuildArchive:
+    """
+    Append-only cold storage for one guild's history: immutable compressed
+    segments plus a small JSON index of the sort_key range each one covers.
+    All methods block on file IO and are meant to be run in a thread.
+    """
+
+    def __init__(self, guild_id: str, directory: str = ARCHIVE_DIR):
+        self.guild_id = guild_id
+        self.directory = os.path.join(directory, guild_id)
+        self.index_path = os.path.join(self.directory, 'index.json')
+
+    def segments(self) -> List[Dict[str, Any]]:
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def _save(self, segments: List[Dict[str, Any]]) -> None:
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(segments, f, indent=2)
+        os.replace(temp_path, self.index_path)
+
+    def add(self, entry: Dict[str, Any]) -> None:
+        segments = self.segments()
+        segments.append(entry)
+        segments.sort(key=lambda segment: segment["first_sort_key"])
+        self._save(segments)
+
+    def open_segment(self) -> SegmentWriter:
+        return SegmentWriter(self)
+
+    def read_segment(self, entry: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        with gzip.open(os.path.join(self.directory, entry["file"]), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def load_segment(self, entry: Dict[str, Any]) -> List[Dict[str, Any]]:
+        return list(self.read_segment(entry))
+
+    def remove_segment(self, entry: Dict[str, Any]) -> None:
+        self._save([segment for segment in self.segments() if segment["file"] != entry["file"]])
+        path = os.path.join(self.directory, entry["file"])
+        if os.path.exists(path):
+            os.remove(path)
+
+    def clear(self) -> None:
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
+
+
+async def run_command(args: argparse.Namespace) -> None:
+    # Imported here because the history module itself depends on this one
+    from lib import guild_interaction_db
+
+    try:
+        if args.command == 'list':
+            for segment in GuildArchive(args.guild).segments():
+                print(f"{segment['file']}: {segment['count']} messages, archived {segment['created_at']}")
+        elif args.command == 'restore':
+            restored = await guild_interaction_db.restore_history(args.guild, args.since)
+            print(f"Restored {restored} messages into the live history of guild {args.guild}")
+        elif args.command == 'archive':
+            archived = await guild_interaction_db.maintain_context_size_limit(args.guild)
+            print(f"Archived {archived} messages of guild {args.guild}")
+    finally:
+        await guild_interaction_db.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Inspect, run or restore the cold-storage archive of a guild's history.")
+    parser.add_argument('command', choices=('list', 'archive', 'restore'))
+    parser.add_argument('--guild', required=True)
+    parser.add_argument('--since', type=int, default=None, help="Only restore segments ending at or after this sort key")
+    asyncio.run(run_command(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
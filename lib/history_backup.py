@@ -0,0 +1,137 @@
+import os
+import time
+import glob
+import shutil
+import sqlite3
+import asyncio
+import argparse
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from lib.history_layout import MEMORIES_DIR
+
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'backups')
+BACKUP_INTERVAL_HOURS = float(os.getenv('BACKUP_INTERVAL_HOURS', '0'))  # 0 disables scheduled backups
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))  # Snapshots kept before the oldest is removed
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '256'))
+BACKUP_STEP_SLEEP = float(os.getenv('BACKUP_STEP_SLEEP', '0.005'))  # Seconds between steps, to throttle IO
+# A write from another connection between two steps restarts the copy; after this many
+# restarts the rest is copied in one step, which in WAL mode only needs a read snapshot
+BACKUP_MAX_RESTARTS = 3
+
+backup_task: Optional[asyncio.Task] = None
+backup_lock = asyncio.Lock()
+
+
+class TooManyRestarts(Exception):
+    pass
+
+
+def backup_database(source_path: str, target_path: str, pages: int = BACKUP_PAGES_PER_STEP, step_sleep: float = BACKUP_STEP_SLEEP) -> None:
+    """
+    Copies one database with SQLite's online backup API, `pages` pages per
+    step. Blocks, so it is run in a worker thread; each step only holds a read
+    lock on the source, and live connections keep writing in between.
+    """
+    temp_path = target_path + '.tmp'
+    source = sqlite3.connect(source_path)
+    try:
+        for step_pages in (pages, -1):
+            target = sqlite3.connect(temp_path)
+            restarts = 0
+            last_remaining = None
+
+            def progress(status: int, remaining: int, total: int) -> None:
+                nonlocal restarts, last_remaining
+                if last_remaining is not None and remaining > last_remaining:
+                    restarts += 1
+                    if restarts > BACKUP_MAX_RESTARTS:
+                        raise TooManyRestarts()
+                last_remaining = remaining
+                # sqlite3 only sleeps between steps when the source is busy, so throttling happens here
+                if remaining and step_sleep:
+                    time.sleep(step_sleep)
+
+            try:
+                source.backup(target, pages=step_pages, progress=progress)
+            except TooManyRestarts:
+                continue
+            finally:
+                target.close()
+            os.replace(temp_path, target_path)
+            return
+    finally:
+        source.close()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def list_snapshots(directory: str = BACKUP_DIR) -> List[str]:
+    return sorted(path for path in glob.glob(os.path.join(directory, '*')) if os.path.isdir(path) and not path.endswith('.partial'))
+
+
+def prune_snapshots(directory: str = BACKUP_DIR, keep: int = BACKUP_KEEP) -> None:
+    snapshots = list_snapshots(directory)
+    for path in snapshots[:-keep] if keep > 0 else []:
+        shutil.rmtree(path)
+
+
+async def create_snapshot(directory: str = BACKUP_DIR) -> str:
+    """Backs up every history database into a new timestamped folder and returns its path."""
+    async with backup_lock:
+        snapshot_dir = base_dir = os.path.join(directory, datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ'))
+        suffix = 1
+        while os.path.exists(snapshot_dir):
+            snapshot_dir = f'{base_dir}-{suffix}'
+            suffix += 1
+        partial_dir = snapshot_dir + '.partial'
+        os.makedirs(partial_dir, exist_ok=True)
+        try:
+            for source_path in sorted(glob.glob(f'{MEMORIES_DIR}/*.sqlite')):
+                target_path = os.path.join(partial_dir, os.path.basename(source_path))
+                await asyncio.to_thread(backup_database, source_path, target_path)
+            # Only complete snapshots get a timestamped name, so a crash never leaves a half backup behind one
+            os.replace(partial_dir, snapshot_dir)
+        except BaseException:
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            raise
+        await asyncio.to_thread(prune_snapshots, directory)
+        return snapshot_dir
+
+
+async def _backup_loop() -> None:
+    while True:
+        await asyncio.sleep(BACKUP_INTERVAL_HOURS * 3600)
+        try:
+            snapshot_dir = await create_snapshot()
+            print(f"History backup written to {snapshot_dir}")
+        except Exception as e:
+            print(f"Error backing up history databases: {e}")
+
+
+def start() -> None:
+    global backup_task
+    if BACKUP_INTERVAL_HOURS > 0 and (backup_task is None or backup_task.done()):
+        backup_task = asyncio.get_running_loop().create_task(_backup_loop())
+
+
+def close() -> None:
+    global backup_task
+    if backup_task:
+        backup_task.cancel()
+        backup_task = None
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Take a snapshot of every history database while the bot keeps running.")
+    parser.add_argument('--list', action='store_true', help="List existing snapshots instead of taking one")
+    args = parser.parse_args()
+    if args.list:
+        for path in list_snapshots():
+            print(path)
+        return
+    print(f"History backup written to {asyncio.run(create_snapshot())}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import os
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Any, Iterable, Optional, Sequence, Tuple
+
+HISTORY_CACHE_TURNS = int(os.getenv('HISTORY_CACHE_TURNS', '2000'))  # Newest turns kept per guild
+HISTORY_CACHE_MAX_CHARS = int(os.getenv('HISTORY_CACHE_MAX_CHARS', str(64 * 1024 * 1024)))  # Across all guilds
+
+
+class CachedTurn:
+    __slots__ = ('message_id', 'role', 'content', 'timestamp', 'sort_key', 'chunk_ids')
+
+    def __init__(self, message_id: str, role: str, content: str, timestamp: Any, sort_key: int, chunk_ids: Sequence[str] = ()):
+        self.message_id = message_id
+        self.role = role
+        self.content = content or ''
+        self.timestamp = timestamp
+        self.sort_key = sort_key
+        # Ids of the further Discord messages a long response was split across
+        self.chunk_ids = list(chunk_ids)
+
+    def to_history_item(self) -> Dict[str, Any]:
+        return {"message_id": self.message_id, "content": {"role": self.role, "parts": [self.content]}, "timestamp": self.timestamp}
+
+
+class GuildHistoryBuffer:
+    def __init__(self, max_turns: int, complete: bool):
+        self.turns: Deque[CachedTurn] = deque()
+        self.max_turns = max_turns
+        # True while the buffer holds every row of the guild's table
+        self.complete = complete
+        self.chars = 0
+
+    def _append(self, turn: CachedTurn) -> int:
+        self.turns.append(turn)
+        self.chars += len(turn.content)
+        freed = 0
+        while len(self.turns) > self.max_turns:
+            freed += self._drop_oldest()
+        return freed
+
+    def _drop_oldest(self) -> int:
+        dropped = self.turns.popleft()
+        self.chars -= len(dropped.content)
+        self.complete = False
+        return len(dropped.content)
+
+    def find(self, message_id: str) -> Optional[CachedTurn]:
+        for turn in reversed(self.turns):
+            if turn.message_id == message_id or message_id in turn.chunk_ids:
+                return turn
+        return None
+
+    def upsert(self, turn: CachedTurn) -> int:
+        """Returns the change in cached characters."""
+        existing = self.find(turn.message_id)
+        if existing is not None:
+            # Matches the database upsert, which keeps the original timestamp and position
+            delta = len(turn.content) - len(existing.content)
+            existing.role = turn.role
+            existing.content = turn.content
+            if turn.chunk_ids:
+                existing.chunk_ids = turn.chunk_ids
+            self.chars += delta
+            return delta
+
+        if not self.turns or turn.sort_key >= self.turns[-1].sort_key:
+            return len(turn.content) - self._append(turn)
+
+        if turn.sort_key < self.turns[0].sort_key and not self.complete:
+            # Older than the cached window, so the database alone holds it
+            return 0
+
+        index = len(self.turns)
+        while index > 0 and self.turns[index - 1].sort_key > turn.sort_key:
+            index -= 1
+        self.turns.insert(index, turn)
+        self.chars += len(turn.content)
+        freed = 0
+        while len(self.turns) > self.max_turns:
+            freed += self._drop_oldest()
+        return len(turn.content) - freed
+
+    def remove(self, message_id: str) -> int:
+        turn = self.find(message_id)
+        if turn is None:
+            return 0
+        # Like the database, a split response stays until its last chunk is deleted
+        if turn.chunk_ids:
+            if message_id in turn.chunk_ids:
+                turn.chunk_ids.remove(message_id)
+            else:
+                turn.message_id = min(turn.chunk_ids)
+                turn.chunk_ids.remove(turn.message_id)
+            return 0
+        self.turns.remove(turn)
+        self.chars -= len(turn.content)
+        return -len(turn.content)
+
+    def trim(self, keep: int) -> int:
+        freed = 0
+        while len(self.turns) > keep:
+            dropped = self.turns.popleft()
+            self.chars -= len(dropped.content)
+            freed += len(dropped.content)
+        return freed
+
+    def tail(self, max_chars: Optional[int], max_turns: Optional[int], after_sort_key: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        selected = []
+        used_chars = 0
+        for turn in reversed(self.turns):
+            if max_turns is not None and len(selected) >= max_turns:
+                break
+            if after_sort_key is not None and turn.sort_key <= after_sort_key:
+                break
+            used_chars += len(turn.content)
+            if max_chars is not None and used_chars > max_chars:
+                break
+            selected.append(turn)
+        else:
+            # Ran out of cached turns before a budget was reached
+            if not self.complete and (max_turns is None or len(selected) < max_turns):
+                return None
+        selected.reverse()
+        return [turn.to_history_item() for turn in selected]
+
+
+class HistoryCache:
+    """
+    Write-through cache of the newest history turns per guild. Every write to
+    the history database is mirrored here so prompts for active guilds can be
+    built without reading SQLite; the least recently used guilds are dropped
+    once the cache exceeds its character budget.
+    """
+
+    def __init__(self, max_turns: int = HISTORY_CACHE_TURNS, max_chars: int = HISTORY_CACHE_MAX_CHARS):
+        self.max_turns = max_turns
+        self.max_chars = max_chars
+        self.buffers: 'OrderedDict[str, GuildHistoryBuffer]' = OrderedDict()
+        # Bumped on every write so a load that raced with a write is discarded
+        self.versions: Dict[str, int] = {}
+        self.total_chars = 0
+        self.hits = 0
+        self.misses = 0
+
+    def version(self, guild_id: str) -> int:
+        return self.versions.get(guild_id, 0)
+
+    def _bump(self, guild_id: str) -> None:
+        self.versions[guild_id] = self.versions.get(guild_id, 0) + 1
+
+    def _touch(self, guild_id: str) -> Optional[GuildHistoryBuffer]:
+        buffer = self.buffers.get(guild_id)
+        if buffer is not None:
+            self.buffers.move_to_end(guild_id)
+        return buffer
+
+    def _evict(self) -> None:
+        # Never evict the most recently used guild, even if it alone is over budget
+        while self.total_chars > self.max_chars and len(self.buffers) > 1:
+            _, buffer = self.buffers.popitem(last=False)
+            self.total_chars -= buffer.chars
+
+    def fill(self, guild_id: str, rows: Iterable[Tuple[str, str, str, Any, int, Sequence[str]]], complete: bool, version: int) -> None:
+        """Installs rows read from the database, oldest first, unless a write happened since `version`."""
+        if self.version(guild_id) != version:
+            return
+        self._drop(guild_id)
+        buffer = GuildHistoryBuffer(self.max_turns, complete)
+        for row in rows:
+            buffer._append(CachedTurn(*row))
+        self.buffers[guild_id] = buffer
+        self.total_chars += buffer.chars
+        self._evict()
+
+    def loaded(self, guild_id: str) -> bool:
+        return guild_id in self.buffers
+
+    def tail(self, guild_id: str, max_chars: Optional[int] = None, max_turns: Optional[int] = None, after_sort_key: Optional[int] = None) -> Optional[List[Dict[str, Any]]]:
+        buffer = self._touch(guild_id)
+        result = buffer.tail(max_chars, max_turns, after_sort_key) if buffer is not None else None
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def upsert(self, guild_id: str, message_id: str, role: str, content: str, timestamp: Any, sort_key: int, chunk_ids: Sequence[str] = ()) -> None:
+        self._bump(guild_id)
+        buffer = self._touch(guild_id)
+        if buffer is not None:
+            self.total_chars += buffer.upsert(CachedTurn(message_id, role, content, timestamp, sort_key, chunk_ids))
+            self._evict()
+
+    def remove(self, guild_id: str, message_id: str) -> None:
+        self._bump(guild_id)
+        buffer = self.buffers.get(guild_id)
+        if buffer is not None:
+            self.total_chars += buffer.remove(message_id)
+
+    def trim(self, guild_id: str, keep: int) -> None:
+        """Mirrors the database dropping all but its newest `keep` rows."""
+        buffer = self.buffers.get(guild_id)
+        if buffer is not None:
+            self.total_chars -= buffer.trim(keep)
+
+    def clear(self, guild_id: str) -> None:
+        self._bump(guild_id)
+        self._drop(guild_id)
+        # An empty table is fully described by an empty buffer
+        self.buffers[guild_id] = GuildHistoryBuffer(self.max_turns, complete=True)
+
+    def invalidate(self, guild_id: str) -> None:
+        self._bump(guild_id)
+        self._drop(guild_id)
+
+    def invalidate_prefix(self, prefix: str) -> None:
+        for key in [key for key in self.buffers if key.startswith(prefix)]:
+            self.invalidate(key)
+
+    def _drop(self, guild_id: str) -> None:
+        buffer = self.buffers.pop(guild_id, None)
+        if buffer is not None:
+            self.total_chars -= buffer.chars
+
+    def stats(self) -> Dict[str, int]:
+        return {"guilds": len(self.buffers), "chars": self.total_chars, "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,116 @@
+import os
+import glob
+import zlib
+import asyncio
+import argparse
+from typing import Dict
+
+import aiosqlite
+
+from lib.db_pool import SQLITE_AUTO_VACUUM
+from lib.history_schema import migrate, PER_GUILD_DB_PATTERN
+
+MEMORIES_DIR = 'memories'
+
+# 'per_guild' keeps one database file per guild; 'shared' puts every guild into
+# HISTORY_SHARDS databases keyed by a guild_id column
+HISTORY_LAYOUT = os.getenv('HISTORY_LAYOUT', 'per_guild')
+HISTORY_SHARDS = int(os.getenv('HISTORY_SHARDS', '1'))
+
+LAYOUTS = ('per_guild', 'shared')
+
+
+def get_db_path(guild_id: str, layout: str = HISTORY_LAYOUT, shards: int = HISTORY_SHARDS) -> str:
+    if layout == 'per_guild':
+        return f'{MEMORIES_DIR}/{guild_id}_histories.sqlite'
+    if layout == 'shared':
+        if shards <= 1:
+            return f'{MEMORIES_DIR}/histories.sqlite'
+        # crc32 rather than hash() so a guild maps to the same shard across restarts
+        return f'{MEMORIES_DIR}/histories_{zlib.crc32(guild_id.encode()) % shards}.sqlite'
+    raise ValueError(f"Unknown history layout '{layout}', expected one of {', '.join(LAYOUTS)}")
+
+
+def find_per_guild_databases() -> Dict[str, str]:
+    databases = {}
+    for path in glob.glob(f'{MEMORIES_DIR}/*_histories.sqlite'):
+        match = PER_GUILD_DB_PATTERN.match(os.path.basename(path))
+        if match:
+            databases[match.group(1)] = path
+    return databases
+
+
+async def copy_guild_database(source_path: str, target_path: str, guild_id: str) -> int:
+    """
+    Copies one guild's messages, chunk mappings, summaries and sync cursors.
+    guild_stats needs no copy: the target's insert trigger counts the rows as they arrive.
+    """
+    # Bring the source up to date first so it has sort_key and guild_id columns to copy
+    async with aiosqlite.connect(source_path) as source:
+        await migrate(source)
+
+    async with aiosqlite.connect(target_path) as target:
+        # Set before the first write, as the pool does, so a new shared file never needs a full VACUUM to switch
+        await target.execute(f'PRAGMA auto_vacuum={SQLITE_AUTO_VACUUM}')
+        await target.execute('PRAGMA journal_mode=WAL')
+        await migrate(target)
+        await target.execute('ATTACH DATABASE ? AS source', (source_path,))
+        try:
+            cursor = await target.execute('''
+                INSERT OR IGNORE INTO messages (message_id, role, content, timestamp, sort_key, channel_id, guild_id)
+                SELECT message_id, role, content, timestamp, sort_key, channel_id, ? FROM source.messages
+                ORDER BY sort_key, id
+            ''', (guild_id,))
+            copied = cursor.rowcount
+            # Without its chunk mapping a split reply would be synced back in as one row per chunk
+            await target.execute('''
+                INSERT OR IGNORE INTO message_chunks (chunk_id, message_id)
+                SELECT chunk_id, message_id FROM source.message_chunks
+            ''')
+            # Summaries have no natural key, so a re-run skips spans the target already has
+            await target.execute('''
+                INSERT INTO history_summaries (guild_id, level, first_sort_key, last_sort_key, turn_count, content, created_at)
+                SELECT ?1, level, first_sort_key, last_sort_key, turn_count, content, created_at FROM source.history_summaries s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM history_summaries t
+                    WHERE t.guild_id = ?1 AND t.level = s.level AND t.first_sort_key = s.first_sort_key
+                )
+                ORDER BY id
+            ''', (guild_id,))
+            await target.execute('''
+                INSERT OR REPLACE INTO sync_cursors (channel_id, last_message_id, guild_id)
+                SELECT channel_id, last_message_id, ? FROM source.sync_cursors
+            ''', (guild_id,))
+            await target.commit()
+        finally:
+            await target.execute('DETACH DATABASE source')
+    return copied
+
+
+async def migrate_to_shared(shards: int = HISTORY_SHARDS, remove_source: bool = False) -> None:
+    """
+    Copies every per-guild history database into the shared layout. Guilds that
+    were already copied are skipped row by row, so the migration can be re-run.
+    """
+    databases = find_per_guild_databases()
+    print(f"Migrating {len(databases)} guild databases into {max(shards, 1)} shared database(s)")
+    for guild_id, source_path in sorted(databases.items()):
+        target_path = get_db_path(guild_id, 'shared', shards)
+        copied = await copy_guild_database(source_path, target_path, guild_id)
+        print(f"Guild {guild_id}: copied {copied} messages into {target_path}")
+        if remove_source:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(source_path + suffix):
+                    os.remove(source_path + suffix)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Move guild histories from one file per guild into the shared layout.")
+    parser.add_argument('--shards', type=int, default=HISTORY_SHARDS, help="Number of shared databases to spread guilds across")
+    parser.add_argument('--remove-source', action='store_true', help="Delete each per-guild file after it has been copied")
+    args = parser.parse_args()
+    asyncio.run(migrate_to_shared(args.shards, args.remove_source))
+
+
+if __name__ == "__main__":
+    main()
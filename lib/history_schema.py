@@ -0,0 +1,265 @@
+import os
+import re
+import aiosqlite
+from datetime import datetime, timezone
+from typing import List, Callable, Awaitable, Optional, Union
+
+DISCORD_EPOCH = 1420070400000  # First second of 2015 in milliseconds
+PER_GUILD_DB_PATTERN = re.compile(r'^(\d+)_histories\.sqlite$')
+DISCORD_MESSAGE_LIMIT = 2000  # Longer responses are sent as several messages
+
+
+def snowflake_from_datetime(dt: datetime) -> int:
+    if dt.tzinfo is None:
+        dt = dt.astimezone(timezone.utc)
+    return max(int(dt.timestamp() * 1000) - DISCORD_EPOCH, 0) << 22
+
+
+def sort_key_for(message_id: str, timestamp: Optional[Union[datetime, str]] = None) -> int:
+    """
+    Ordering key for a history row. Discord ids are snowflakes and already sort
+    by creation time; anything else is mapped onto the same scale from its timestamp.
+    """
+    if message_id.isdigit():
+        return int(message_id)
+    if isinstance(timestamp, str):
+        try:
+            timestamp = datetime.fromisoformat(timestamp)
+        except ValueError:
+            timestamp = None
+    return snowflake_from_datetime(timestamp or datetime.now(timezone.utc))
+
+
+async def _create_messages_table(db: aiosqlite.Connection) -> None:
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            message_id TEXT UNIQUE,
+            role TEXT,
+            content TEXT,
+            timestamp DATETIME
+        )
+    ''')
+
+
+async def _add_sort_key(db: aiosqlite.Connection) -> None:
+    await db.execute('ALTER TABLE messages ADD COLUMN sort_key INTEGER')
+    await db.execute('''
+        UPDATE messages SET sort_key = CAST(message_id AS INTEGER)
+        WHERE message_id != '' AND message_id NOT GLOB '*[^0-9]*'
+    ''')
+    async with db.execute('SELECT id, message_id, timestamp FROM messages WHERE sort_key IS NULL') as cursor:
+        rows = await cursor.fetchall()
+    await db.executemany('UPDATE messages SET sort_key = ? WHERE id = ?',
+                         [(sort_key_for(message_id or '', timestamp), row_id) for row_id, message_id, timestamp in rows])
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_messages_sort_key ON messages(sort_key)')
+
+
+async def _add_row_counter(db: aiosqlite.Connection) -> None:
+    # Kept up to date by triggers so the context size check never needs COUNT(*)
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS message_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            row_count INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('INSERT OR REPLACE INTO message_stats (id, row_count) SELECT 1, COUNT(*) FROM messages')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_count_insert AFTER INSERT ON messages
+        BEGIN
+            UPDATE message_stats SET row_count = row_count + 1 WHERE id = 1;
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_count_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE message_stats SET row_count = row_count - 1 WHERE id = 1;
+        END
+    ''')
+
+
+async def _add_sync_cursors(db: aiosqlite.Connection) -> None:
+    # Newest Discord message id already synced from each channel
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS sync_cursors (
+            channel_id INTEGER PRIMARY KEY,
+            last_message_id INTEGER NOT NULL
+        )
+    ''')
+
+
+async def _database_guild_id(db: aiosqlite.Connection) -> Optional[str]:
+    # Per-guild files are named after their guild; shared databases are not
+    async with db.execute('PRAGMA database_list') as cursor:
+        for _, name, path in await cursor.fetchall():
+            if name == 'main' and path:
+                match = PER_GUILD_DB_PATTERN.match(os.path.basename(path))
+                return match.group(1) if match else None
+    return None
+
+
+async def _add_guild_id(db: aiosqlite.Connection) -> None:
+    await db.execute('ALTER TABLE messages ADD COLUMN guild_id TEXT')
+    await db.execute('ALTER TABLE sync_cursors ADD COLUMN guild_id TEXT')
+    guild_id = await _database_guild_id(db)
+    if guild_id is not None:
+        await db.execute('UPDATE messages SET guild_id = ?', (guild_id,))
+        await db.execute('UPDATE sync_cursors SET guild_id = ?', (guild_id,))
+
+    await db.execute('DROP INDEX IF EXISTS idx_messages_sort_key')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_messages_guild_sort_key ON messages(guild_id, sort_key)')
+
+    # Row counts are now kept per guild so several guilds can share one database
+    await db.execute('DROP TRIGGER IF EXISTS messages_count_insert')
+    await db.execute('DROP TRIGGER IF EXISTS messages_count_delete')
+    await db.execute('DROP TABLE IF EXISTS message_stats')
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS guild_stats (
+            guild_id TEXT PRIMARY KEY,
+            row_count INTEGER NOT NULL
+        )
+    ''')
+    await db.execute('''
+        INSERT OR REPLACE INTO guild_stats (guild_id, row_count)
+        SELECT guild_id, COUNT(*) FROM messages WHERE guild_id IS NOT NULL GROUP BY guild_id
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_guild_count_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO guild_stats (guild_id, row_count) VALUES (NEW.guild_id, 1)
+            ON CONFLICT(guild_id) DO UPDATE SET row_count = row_count + 1;
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_guild_count_delete AFTER DELETE ON messages
+        BEGIN
+            UPDATE guild_stats SET row_count = row_count - 1 WHERE guild_id = OLD.guild_id;
+        END
+    ''')
+
+
+async def _add_channel_id(db: aiosqlite.Connection) -> None:
+    # Left NULL for older rows: which channel they came from is unknown, so they stay in guild-wide context only
+    await db.execute('ALTER TABLE messages ADD COLUMN channel_id INTEGER')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_messages_guild_channel_sort_key ON messages(guild_id, channel_id, sort_key)')
+
+
+async def _add_message_chunks(db: aiosqlite.Connection) -> None:
+    # Extra Discord message ids of a response that was split into chunks, mapped to the one row holding its text
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS message_chunks (
+            chunk_id TEXT PRIMARY KEY,
+            message_id TEXT NOT NULL
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_message_chunks_message_id ON message_chunks(message_id)')
+
+    # Responses used to be stored in full once per chunk; keep the first copy and map the rest to it.
+    # Only split responses are longer than one Discord message, so shorter repeats are left alone.
+    await db.execute('''
+        WITH firsts AS (
+            SELECT guild_id, content, MIN(id) AS first_id FROM messages
+            WHERE role = 'model' AND length(content) > ?
+            GROUP BY guild_id, content HAVING COUNT(*) > 1
+        )
+        INSERT OR IGNORE INTO message_chunks (chunk_id, message_id)
+        SELECT m.message_id, p.message_id FROM firsts f
+        JOIN messages p ON p.id = f.first_id
+        JOIN messages m ON m.role = 'model' AND m.guild_id IS f.guild_id AND m.content = f.content AND m.id != f.first_id
+    ''', (DISCORD_MESSAGE_LIMIT,))
+    await db.execute('DELETE FROM messages WHERE message_id IN (SELECT chunk_id FROM message_chunks)')
+
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_chunks_delete AFTER DELETE ON messages
+        BEGIN
+            DELETE FROM message_chunks WHERE message_id = OLD.message_id;
+        END
+    ''')
+
+
+async def fts5_available(db: aiosqlite.Connection) -> bool:
+    async with db.execute("SELECT 1 FROM pragma_compile_options WHERE compile_options = 'ENABLE_FTS5'") as cursor:
+        return await cursor.fetchone() is not None
+
+
+async def _add_full_text_index(db: aiosqlite.Connection) -> None:
+    # Without FTS5 the history still works, search_history just finds nothing
+    if not await fts5_available(db):
+        return
+
+    # External content table over messages, kept in step by triggers on every write path
+    await db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='messages', content_rowid='id')")
+    await db.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+        BEGIN
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+        END
+    ''')
+    await db.execute('''
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages
+        BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', OLD.id, OLD.content);
+            INSERT INTO messages_fts (rowid, content) VALUES (NEW.id, NEW.content);
+        END
+    ''')
+
+
+async def _add_history_summaries(db: aiosqlite.Connection) -> None:
+    # Digests of older spans of history; level 0 covers raw turns, higher levels fold earlier summaries
+    await db.execute('''
+        CREATE TABLE IF NOT EXISTS history_summaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            guild_id TEXT NOT NULL,
+            level INTEGER NOT NULL DEFAULT 0,
+            first_sort_key INTEGER NOT NULL,
+            last_sort_key INTEGER NOT NULL,
+            turn_count INTEGER NOT NULL,
+            content TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    await db.execute('CREATE INDEX IF NOT EXISTS idx_history_summaries_guild_sort_key ON history_summaries(guild_id, first_sort_key)')
+
+
+# Each entry upgrades the schema by one version; never edit or reorder released entries
+MIGRATIONS: List[Callable[[aiosqlite.Connection], Awaitable[None]]] = [
+    _create_messages_table,
+    _add_sort_key,
+    _add_row_counter,
+    _add_sync_cursors,
+    _add_guild_id,
+    _add_channel_id,
+    _add_message_chunks,
+    _add_full_text_index,
+    _add_history_summaries,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+async def get_schema_version(db: aiosqlite.Connection) -> int:
+    async with db.execute('PRAGMA user_version') as cursor:
+        return (await cursor.fetchone())[0]
+
+
+async def migrate(db: aiosqlite.Connection) -> None:
+    version = await get_schema_version(db)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f"History database schema version {version} is newer than supported version {SCHEMA_VERSION}")
+
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        await db.execute('BEGIN')
+        try:
+            await MIGRATIONS[target - 1](db)
+            await db.execute(f'PRAGMA user_version = {target}')
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
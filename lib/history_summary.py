@@ -0,0 +1,50 @@
+import os
+from typing import Any, Dict, List, Optional, Protocol
+
+SUMMARY_SPAN_TURNS = int(os.getenv('SUMMARY_SPAN_TURNS', '200'))  # Turns folded into one summary record
+SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '200'))  # Newest turns that are never summarized
+SUMMARY_MAX_RECORDS = 24  # Past this many summaries, the oldest are folded into one
+SUMMARY_MERGE_COUNT = 6
+SUMMARY_IDLE_SECONDS = int(os.getenv('SUMMARY_IDLE_SECONDS', '120'))  # Quiet time before a guild is compacted
+SUMMARY_MAX_CHARS = 4000
+
+SUMMARY_PROMPT = """Summarize the conversation below for your own future reference. Keep names, facts, \
+decisions, promises and open threads; drop greetings and small talk. Write at most {max_chars} characters \
+of plain prose in the language the conversation uses.
+
+{previous}Conversation:
+{transcript}"""
+
+
+class Summarizer(Protocol):
+    async def summarize(self, guild_id: str, turns: List[Dict[str, Any]], previous: Optional[str] = None) -> Optional[str]:
+        """
+        Returns a summary of `turns` (history items, oldest first), or None when
+        the guild should not be compacted. `previous` is the summary of what came
+        just before, for continuity.
+        """
+        ...
+
+
+def format_transcript(turns: List[Dict[str, Any]]) -> str:
+    return "\n".join(f"{turn['content']['role']}: {turn['content']['parts'][0]}" for turn in turns)
+
+
+def build_summary_prompt(turns: List[Dict[str, Any]], previous: Optional[str] = None) -> str:
+    previous_text = f"Summary of what came before:\n{previous}\n\n" if previous else ""
+    return SUMMARY_PROMPT.format(max_chars=SUMMARY_MAX_CHARS, previous=previous_text, transcript=format_transcript(turns))
+
+
+class StubSummarizer:
+    """
+    Deterministic summarizer that needs no model: it keeps the opening of each
+    turn until the summary budget is spent.
+    """
+
+    def __init__(self, chars_per_turn: int = 80, max_chars: int = SUMMARY_MAX_CHARS):
+        self.chars_per_turn = chars_per_turn
+        self.max_chars = max_chars
+
+    async def summarize(self, guild_id: str, turns: List[Dict[str, Any]], previous: Optional[str] = None) -> Optional[str]:
+        lines = [f"{turn['content']['role']}: {turn['content']['parts'][0][:self.chars_per_turn]}" for turn in turns]
+        return "\n".join(lines)[:self.max_chars]
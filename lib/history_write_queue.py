@@ -0,0 +1,106 @@
+import asyncio
+from typing import Dict, List, Any, Tuple, Callable, Awaitable, Optional
+
+FLUSH_INTERVAL = 0.005  # Seconds to wait for more writes before committing a batch
+MAX_BATCH_SIZE = 64
+
+
+class WriteOp:
+    def __init__(self, kind: str, params: Tuple[Any, ...]):
+        self.kind = kind
+        self.params = params
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+
+def _consume_result(future: asyncio.Future) -> None:
+    # Fire-and-forget writes are reported by the queue itself, so mark the exception as retrieved
+    if not future.cancelled():
+        future.exception()
+
+
+class GuildWriteQueue:
+    def __init__(self, guild_id: str, apply_batch: Callable[[str, List[WriteOp]], Awaitable[None]],
+                 flush_interval: float, max_batch_size: int):
+        self.guild_id = guild_id
+        self.apply_batch = apply_batch
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.pending: List[WriteOp] = []
+        self.in_flight: List[WriteOp] = []
+        self.wakeup = asyncio.Event()
+        self.worker: Optional[asyncio.Task] = None
+
+    def submit(self, op: WriteOp) -> asyncio.Future:
+        self.pending.append(op)
+        if len(self.pending) >= self.max_batch_size:
+            self.wakeup.set()
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.get_running_loop().create_task(self._run())
+        return op.future
+
+    async def _run(self) -> None:
+        while self.pending:
+            if len(self.pending) < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            self.in_flight = batch
+            try:
+                await self.apply_batch(self.guild_id, batch)
+            except Exception as e:
+                print(f"Error writing history batch for guild {self.guild_id}: {e}")
+                for op in batch:
+                    if not op.future.done():
+                        op.future.set_exception(e)
+            else:
+                for op in batch:
+                    if not op.future.done():
+                        op.future.set_result(None)
+            finally:
+                self.in_flight = []
+
+    async def flush(self) -> None:
+        futures = [op.future for op in self.in_flight + self.pending]
+        if futures:
+            # asyncio.wait leaves the futures alone if the flushing task is cancelled; they belong to other writers
+            await asyncio.wait(futures)
+
+
+class HistoryWriteQueue:
+    """
+    Write-behind queue that groups history writes per guild so a burst of
+    messages is committed in one transaction instead of one fsync per row.
+    """
+
+    def __init__(self, apply_batch: Callable[[str, List[WriteOp]], Awaitable[None]],
+                 flush_interval: float = FLUSH_INTERVAL, max_batch_size: int = MAX_BATCH_SIZE):
+        self.apply_batch = apply_batch
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        self.queues: Dict[str, GuildWriteQueue] = {}
+
+    def submit(self, guild_id: str, kind: str, params: Tuple[Any, ...], wait: bool = True) -> asyncio.Future:
+        queue = self.queues.get(guild_id)
+        if queue is None:
+            queue = GuildWriteQueue(guild_id, self.apply_batch, self.flush_interval, self.max_batch_size)
+            self.queues[guild_id] = queue
+        future = queue.submit(WriteOp(kind, params))
+        if not wait:
+            future.add_done_callback(_consume_result)
+        return future
+
+    async def flush(self, guild_id: Optional[str] = None) -> None:
+        if guild_id is not None:
+            queue = self.queues.get(guild_id)
+            if queue:
+                await queue.flush()
+            return
+        await asyncio.gather(*(queue.flush() for queue in list(self.queues.values())))
+
+    def pending_count(self, guild_id: str) -> int:
+        queue = self.queues.get(guild_id)
+        return len(queue.pending) + len(queue.in_flight) if queue else 0
@@ -78,7 +78,7 @@ class InteractionHandler:
                 message, 
                 str(message.guild.id), 
                 self.config_manager.get_guild_config, 
-                self.guild_history_manager.get_guild_history
+                self.guild_history_manager.get_recent_history
             )
             await self.send_response(message, response)
         except Exception as e:
@@ -93,12 +93,12 @@ class InteractionHandler:
             bot_messages.append(bot_message)
         
         full_response = {"role": "model", "parts": [response]}
-        for bot_message in bot_messages:
-            await self.guild_history_manager.update_guild_history(
-                str(message.guild.id), 
-                full_response, 
-                str(bot_message.id)
-            )
+        await self.guild_history_manager.update_guild_history(
+            str(message.guild.id), 
+            full_response, 
+            str(bot_messages[0].id),
+            chunk_ids=[str(bot_message.id) for bot_message in bot_messages[1:]]
+        )
 
     @staticmethod
     def split_message(message: str, max_length: int = 2000) -> List[str]:
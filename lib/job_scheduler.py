@@ -0,0 +1,175 @@
+import os
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+from lib.generation_limiter import TimingStats
+
+T = TypeVar('T')
+
+SCHEDULER_CONCURRENCY = int(os.getenv('SCHEDULER_CONCURRENCY', '16'))  # Replies being worked on at once, across all guilds
+GUILD_CONCURRENCY = int(os.getenv('GUILD_CONCURRENCY', '2'))  # Replies at once within one guild
+CHANNEL_CONCURRENCY = 1  # Replies at once within one channel, so they are posted in order
+GUILD_QUEUE_LIMIT = int(os.getenv('GUILD_QUEUE_LIMIT', '20'))  # Queued replies per guild before new ones are refused
+
+MENTION_LANE = 0  # Messages addressed to the bot; always served before the ambient lane
+AMBIENT_LANE = 1
+LANE_NAMES = ("mention", "ambient")
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    __slots__ = ('guild', 'channel_id', 'lane', 'tag', 'seq', 'granted', 'enqueued_at')
+
+    def __init__(self, guild: 'GuildQueue', channel_id: int, lane: int, tag: float, seq: int):
+        self.guild = guild
+        self.channel_id = channel_id
+        self.lane = lane
+        self.tag = tag
+        self.seq = seq
+        self.granted: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+
+
+class GuildQueue:
+    __slots__ = ('guild_id', 'jobs', 'active', 'last_tag')
+
+    def __init__(self, guild_id: str):
+        self.guild_id = guild_id
+        self.jobs: List[Job] = []
+        self.active = 0
+        self.last_tag = 0.0
+
+
+class JobScheduler:
+    """
+    Decides which queued reply runs next. At most `limit` replies run at once,
+    and no more than `guild_limit` per guild and `channel_limit` per channel.
+    Guilds share the slots by start-time fair queuing: each job is tagged with
+    its guild's virtual start time, which advances by 1/weight per job, so a
+    busy guild queues behind its own backlog instead of everyone else's.
+    Mentions of the bot go in a lane that is served before ambient chatter,
+    though never ahead of an earlier reply in the same channel.
+    """
+
+    def __init__(self, limit: int = SCHEDULER_CONCURRENCY, guild_limit: int = GUILD_CONCURRENCY, channel_limit: int = CHANNEL_CONCURRENCY, queue_limit: int = GUILD_QUEUE_LIMIT):
+        self.limit = limit
+        self.guild_limit = guild_limit
+        self.channel_limit = channel_limit
+        self.queue_limit = queue_limit
+        self.guilds: Dict[str, GuildQueue] = {}
+        self.channels_active: Dict[int, int] = {}
+        self.active = 0
+        self.queued = 0
+        self.virtual_time = 0.0
+        self.seq = 0
+        self.queue_wait = tuple(TimingStats() for _ in LANE_NAMES)
+        self.run_time = TimingStats()
+        self.rejected = 0
+
+    async def run(self, guild_id: str, channel_id: int, call: Callable[[], Awaitable[T]], priority: bool = False, weight: float = 1.0) -> T:
+        """Waits for the job's turn, then runs it. Raises QueueFull if the guild already has too many queued."""
+        job = self._enqueue(guild_id, channel_id, MENTION_LANE if priority else AMBIENT_LANE, weight)
+        try:
+            await job.granted
+        except asyncio.CancelledError:
+            if job.granted.done() and not job.granted.cancelled():
+                # Granted just as it was cancelled; the slot has to be given back
+                self._release(job)
+            else:
+                self._remove(job)
+            raise
+        started_at = time.monotonic()
+        self.queue_wait[job.lane].record(started_at - job.enqueued_at)
+        try:
+            return await call()
+        finally:
+            self.run_time.record(time.monotonic() - started_at)
+            self._release(job)
+
+    def _enqueue(self, guild_id: str, channel_id: int, lane: int, weight: float) -> Job:
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            guild = self.guilds[guild_id] = GuildQueue(guild_id)
+        if len(guild.jobs) >= self.queue_limit:
+            self.rejected += 1
+            raise QueueFull(f"Guild {guild_id} already has {len(guild.jobs)} replies queued")
+        # A guild that was idle starts at the current virtual time rather than catching up on its unused share
+        tag = max(self.virtual_time, guild.last_tag)
+        guild.last_tag = tag + 1.0 / max(weight, 0.01)
+        self.seq += 1
+        job = Job(guild, channel_id, lane, tag, self.seq)
+        guild.jobs.append(job)
+        self.queued += 1
+        self._dispatch()
+        return job
+
+    def _pick(self) -> Optional[Job]:
+        best = None
+        for guild in self.guilds.values():
+            if not guild.jobs or guild.active >= self.guild_limit:
+                continue
+            # A channel's replies are posted in order, so only its oldest pending job may run, whatever its lane
+            seen_channels = set()
+            for job in guild.jobs:
+                if job.channel_id in seen_channels:
+                    continue
+                seen_channels.add(job.channel_id)
+                if self.channels_active.get(job.channel_id, 0) >= self.channel_limit:
+                    continue
+                if best is None or (job.lane, job.tag, job.seq) < (best.lane, best.tag, best.seq):
+                    best = job
+                if job.lane == MENTION_LANE:
+                    # A guild's jobs are in tag order, so its first eligible mention beats everything after it
+                    break
+        return best
+
+    def _dispatch(self) -> None:
+        while self.active < self.limit:
+            job = self._pick()
+            if job is None:
+                return
+            job.guild.jobs.remove(job)
+            self.queued -= 1
+            self.active += 1
+            job.guild.active += 1
+            self.channels_active[job.channel_id] = self.channels_active.get(job.channel_id, 0) + 1
+            self.virtual_time = max(self.virtual_time, job.tag)
+            job.granted.set_result(None)
+
+    def _remove(self, job: Job) -> None:
+        if job in job.guild.jobs:
+            job.guild.jobs.remove(job)
+            self.queued -= 1
+        self._forget(job.guild)
+
+    def _release(self, job: Job) -> None:
+        self.active -= 1
+        job.guild.active -= 1
+        remaining = self.channels_active[job.channel_id] - 1
+        if remaining:
+            self.channels_active[job.channel_id] = remaining
+        else:
+            del self.channels_active[job.channel_id]
+        self._forget(job.guild)
+        self._dispatch()
+
+    def _forget(self, guild: GuildQueue) -> None:
+        # Idle guilds are dropped; their next job starts from the current virtual time anyway
+        if not guild.jobs and not guild.active and guild.last_tag <= self.virtual_time:
+            self.guilds.pop(guild.guild_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        depths = sorted(((len(guild.jobs), guild_id) for guild_id, guild in self.guilds.items() if guild.jobs), reverse=True)
+        return {
+            "limit": self.limit,
+            "active": self.active,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "deepest_guilds": {guild_id: depth for depth, guild_id in depths[:5]},
+            "queue_wait": {name: stats.to_dict() for name, stats in zip(LANE_NAMES, self.queue_wait)},
+            "run_time": self.run_time.to_dict(),
+        }
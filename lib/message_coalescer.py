@@ -0,0 +1,109 @@
+import os
+import time
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import discord
+
+# Quiet seconds to wait for more messages in a channel before replying to all of them at once;
+# 0 replies to every message on its own. A guild can override this with its "coalesce_window" setting
+COALESCE_WINDOW = float(os.getenv('COALESCE_WINDOW', '0'))
+COALESCE_MAX_WAIT = 10.0  # A burst is answered after at most this long, even while messages keep coming
+
+
+class Burst:
+    __slots__ = ('messages', 'started_at', 'timer')
+
+    def __init__(self):
+        self.messages: List[discord.Message] = []
+        self.started_at = time.monotonic()
+        self.timer: Optional[asyncio.Task] = None
+
+
+class Generation:
+    __slots__ = ('messages', 'task')
+
+    def __init__(self, messages: List[discord.Message], task: asyncio.Task):
+        self.messages = messages
+        self.task = task
+
+
+class MessageCoalescer:
+    """
+    Collects messages per channel until the channel has been quiet for the
+    window, then hands them to `handler` as one burst. A message arriving while
+    the previous burst's reply is still being generated cancels that reply and
+    joins its messages, so each burst gets exactly one reply. Once the handler
+    calls `settle`, its reply is being sent and is no longer cancelled.
+    """
+
+    def __init__(self, handler: Callable[[List[discord.Message]], Awaitable[None]], max_wait: float = COALESCE_MAX_WAIT):
+        self.handler = handler
+        self.max_wait = max_wait
+        self.bursts: Dict[int, Burst] = {}
+        self.generations: Dict[int, Generation] = {}
+        self.coalesced = 0
+        self.superseded = 0
+
+    def submit(self, message: discord.Message, window: float) -> None:
+        channel_id = message.channel.id
+        burst = self.bursts.get(channel_id)
+        if burst is None:
+            burst = self.bursts[channel_id] = Burst()
+        else:
+            self.coalesced += 1
+
+        generation = self.generations.pop(channel_id, None)
+        if generation is not None and not generation.task.done():
+            generation.task.cancel()
+            burst.messages[:0] = generation.messages
+            self.superseded += 1
+        burst.messages.append(message)
+
+        if burst.timer is not None:
+            burst.timer.cancel()
+        delay = max(min(window, burst.started_at + self.max_wait - time.monotonic()), 0)
+        burst.timer = asyncio.get_running_loop().create_task(self._fire(channel_id, burst, delay))
+
+    async def _fire(self, channel_id: int, burst: Burst, delay: float) -> None:
+        await asyncio.sleep(delay)
+        if self.bursts.get(channel_id) is not burst:
+            return
+        del self.bursts[channel_id]
+        task = asyncio.get_running_loop().create_task(self._run(burst.messages))
+        self.generations[channel_id] = Generation(burst.messages, task)
+
+    async def _run(self, messages: List[discord.Message]) -> None:
+        try:
+            await self.handler(messages)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Error answering messages in channel {messages[-1].channel.id}: {e}")
+        finally:
+            generation = self.generations.get(messages[-1].channel.id)
+            if generation is not None and generation.task is asyncio.current_task():
+                del self.generations[messages[-1].channel.id]
+
+    def settle(self, channel_id: int) -> None:
+        """Called by the handler once its reply is generated; newer messages then start a new burst."""
+        generation = self.generations.get(channel_id)
+        if generation is not None and generation.task is asyncio.current_task():
+            del self.generations[channel_id]
+
+    def close(self) -> None:
+        for burst in self.bursts.values():
+            if burst.timer is not None:
+                burst.timer.cancel()
+        for generation in self.generations.values():
+            generation.task.cancel()
+        self.bursts.clear()
+        self.generations.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "pending": len(self.bursts),
+            "generating": len(self.generations),
+            "coalesced": self.coalesced,
+            "superseded": self.superseded,
+        }
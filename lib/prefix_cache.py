@@ -0,0 +1,177 @@
+import os
+import time
+import asyncio
+from typing import Any, Dict, List, Optional, Protocol, Tuple
+
+from lib.gemini_clients import registry
+from lib.generation_limiter import GenerationLimiter
+
+# Guilds whose prompt prefix is big enough are sent it as cached content instead of inline;
+# a guild can override this with its "prefix_cache" setting
+PREFIX_CACHE = os.getenv('PREFIX_CACHE', '0') != '0'
+PREFIX_CACHE_TTL = int(os.getenv('PREFIX_CACHE_TTL', '3600'))  # Seconds a cached prefix lives without being used
+PREFIX_CACHE_REFRESH = 300  # Seconds before expiry at which a prefix still in use gets its TTL extended
+PREFIX_CACHE_MIN_TOKENS = 32768  # Gemini refuses to cache less than this
+PREFIX_CACHE_RETRY = 600  # Seconds to send a prefix inline after creating its cache failed
+
+
+class PrefixStore(Protocol):
+    """Where cached prefixes are kept: the Gemini cached-content API, or a dict in a test."""
+
+    async def create(self, api_key: str, model_name: str, contents: List[Dict[str, Any]], ttl: int) -> str:
+        ...
+
+    async def refresh(self, api_key: str, name: str, ttl: int) -> None:
+        ...
+
+    async def delete(self, api_key: str, name: str) -> None:
+        ...
+
+
+class GeminiPrefixStore:
+    def __init__(self, limiter: GenerationLimiter):
+        self.limiter = limiter
+
+    async def create(self, api_key: str, model_name: str, contents: List[Dict[str, Any]], ttl: int) -> str:
+        return await self.limiter.run_sync(registry.create_cached_content, api_key, model_name, contents, ttl)
+
+    async def refresh(self, api_key: str, name: str, ttl: int) -> None:
+        await self.limiter.run_sync(registry.update_cached_content_ttl, api_key, name, ttl)
+
+    async def delete(self, api_key: str, name: str) -> None:
+        await self.limiter.run_sync(registry.delete_cached_content, api_key, name)
+
+
+class CachedPrefix:
+    __slots__ = ('prefix', 'model_name', 'name', 'expires_at', 'failed_at', 'task')
+
+    def __init__(self, prefix: str, model_name: str):
+        self.prefix = prefix
+        self.model_name = model_name
+        self.name: Optional[str] = None
+        self.expires_at = 0.0
+        self.failed_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class PrefixCache:
+    """
+    Keeps the static start of each guild's prompt (system instruction plus RP
+    instructions) registered as cached content, one per guild and API key,
+    since cached content belongs to the key's project. Creating and refreshing
+    happen in the background; until a cache is ready, or after it failed,
+    `get` returns None and the prefix is sent inline as before.
+    """
+
+    def __init__(self, store: PrefixStore, ttl: int = PREFIX_CACHE_TTL, refresh_margin: int = PREFIX_CACHE_REFRESH, retry_after: int = PREFIX_CACHE_RETRY):
+        self.store = store
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.retry_after = retry_after
+        self.entries: Dict[Tuple[str, str], CachedPrefix] = {}
+        self.delete_tasks = set()
+        self.hits = 0
+        self.misses = 0
+        self.creates = 0
+        self.refreshes = 0
+        self.failures = 0
+
+    def get(self, guild_id: str, api_key: str, prefix: str, model_name: str, contents: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Returns the cached content name to use for this request, or None to send
+        the prefix inline. `contents` is what gets cached for `prefix`; a
+        different prefix or model replaces the cache.
+        """
+        key = (guild_id, api_key)
+        entry = self.entries.get(key)
+        # Profiles are rebuilt for any settings change, so an equal prompt is taken over instead of recached
+        if entry is not None and entry.prefix is not prefix:
+            if entry.model_name == model_name and entry.prefix == prefix:
+                entry.prefix = prefix
+            else:
+                self._drop(api_key, entry)
+                entry = None
+        if entry is None:
+            entry = self.entries[key] = CachedPrefix(prefix, model_name)
+
+        now = time.monotonic()
+        if entry.task is None:
+            if entry.name is None or entry.expires_at <= now:
+                if entry.failed_at is None or now - entry.failed_at >= self.retry_after:
+                    entry.name = None
+                    entry.task = asyncio.get_running_loop().create_task(self._create(api_key, entry, model_name, contents))
+            elif entry.expires_at - now < self.refresh_margin:
+                entry.task = asyncio.get_running_loop().create_task(self._refresh(api_key, entry))
+
+        if entry.name is not None and entry.expires_at > now:
+            self.hits += 1
+            return entry.name
+        self.misses += 1
+        return None
+
+    def invalidate(self, guild_id: str, api_key: str) -> None:
+        """Called when a request using the cache failed, so the next ones go inline until it is recreated."""
+        entry = self.entries.get((guild_id, api_key))
+        if entry is not None and entry.task is None:
+            entry.name = None
+            entry.failed_at = time.monotonic()
+
+    async def _create(self, api_key: str, entry: CachedPrefix, model_name: str, contents: List[Dict[str, Any]]) -> None:
+        started_at = time.monotonic()
+        try:
+            entry.name = await self.store.create(api_key, model_name, contents, self.ttl)
+            entry.expires_at = started_at + self.ttl
+            entry.failed_at = None
+            self.creates += 1
+        except Exception as e:
+            entry.failed_at = time.monotonic()
+            self.failures += 1
+            print(f"Error caching prompt prefix for {model_name}, sending it inline: {e}")
+        finally:
+            entry.task = None
+
+    async def _refresh(self, api_key: str, entry: CachedPrefix) -> None:
+        started_at = time.monotonic()
+        try:
+            await self.store.refresh(api_key, entry.name, self.ttl)
+            entry.expires_at = started_at + self.ttl
+            self.refreshes += 1
+        except Exception as e:
+            # Left to expire; the next request after that creates a new one
+            self.failures += 1
+            print(f"Error refreshing cached prompt prefix {entry.name}: {e}")
+        finally:
+            entry.task = None
+
+    def _drop(self, api_key: str, entry: CachedPrefix) -> None:
+        if entry.task is not None:
+            entry.task.cancel()
+        if entry.name is not None:
+            name = entry.name
+
+            async def delete() -> None:
+                try:
+                    await self.store.delete(api_key, name)
+                except Exception as e:
+                    print(f"Error deleting cached prompt prefix {name}: {e}")
+
+            task = asyncio.get_running_loop().create_task(delete())
+            self.delete_tasks.add(task)
+            task.add_done_callback(self.delete_tasks.discard)
+
+    def close(self) -> None:
+        # Remote caches are left to expire on their own TTL
+        for entry in self.entries.values():
+            if entry.task is not None:
+                entry.task.cancel()
+        self.entries.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "creates": self.creates,
+            "refreshes": self.refreshes,
+            "failures": self.failures,
+        }
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+MODELS_CACHE_FILE = 'models_cache.json'  # Written by the model selector
+# Used for models missing from the cache; the smallest limits any listed Gemini model has
+DEFAULT_INPUT_TOKEN_LIMIT = 30720
+DEFAULT_OUTPUT_TOKEN_LIMIT = 2048
+CHARS_PER_TOKEN = 4.0  # Starting estimate until count_tokens has calibrated a model
+PROMPT_TOKEN_MARGIN = 0.05  # Share of the input limit left free for estimation error
+IMAGE_TOKENS = 258  # What Gemini charges for one image
+FILE_TOKENS = int(os.getenv('FILE_TOKENS', '16384'))  # Reserved for an uploaded video, audio or document
+# With calibration on, a model's chars-per-token ratio is measured with count_tokens at most this often
+TOKEN_CALIBRATION = os.getenv('TOKEN_CALIBRATION', '0') != '0'
+TOKEN_CALIBRATION_INTERVAL = 600
+
+
+class ModelLimits:
+    """Input and output token limits per model, read from the model selector's cache file."""
+
+    def __init__(self, path: str = MODELS_CACHE_FILE):
+        self.path = path
+        self.mtime: Optional[float] = None
+        self.limits: Dict[str, Tuple[int, int]] = {}
+
+    def _load(self) -> None:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                models = json.load(f)['models']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error reading model limits from {self.path}: {e}")
+            return
+        limits = {}
+        for model in models:
+            input_limit, output_limit = model.get('input_token_limit'), model.get('output_token_limit')
+            # Models the API listed without limits are stored as 'N/A'
+            if isinstance(input_limit, int) and isinstance(output_limit, int):
+                limits[model['name']] = (input_limit, output_limit)
+        self.limits = limits
+        self.mtime = mtime
+
+    def get(self, model_name: str) -> Tuple[int, int]:
+        self._load()
+        if model_name.startswith('models/'):
+            model_name = model_name[len('models/'):]
+        return self.limits.get(model_name, (DEFAULT_INPUT_TOKEN_LIMIT, DEFAULT_OUTPUT_TOKEN_LIMIT))
+
+
+class TokenEstimator:
+    """
+    Estimates tokens from character counts, one ratio per model. The ratio
+    starts at CHARS_PER_TOKEN and can be calibrated against count_tokens,
+    which is exact but costs a request.
+    """
+
+    def __init__(self, chars_per_token: float = CHARS_PER_TOKEN):
+        self.default_ratio = chars_per_token
+        self.ratios: Dict[str, float] = {}
+        self.calibrated_at: Dict[str, float] = {}
+
+    def ratio(self, model_name: str) -> float:
+        return self.ratios.get(model_name, self.default_ratio)
+
+    def estimate(self, model_name: str, text: str) -> int:
+        return int(len(text) / self.ratio(model_name)) + 1
+
+    def estimate_parts(self, model_name: str, parts: List[Any]) -> int:
+        ratio = self.ratio(model_name)
+        return sum(int(len(part) / ratio) + 1 if isinstance(part, str) else IMAGE_TOKENS for part in parts)
+
+    def needs_calibration(self, model_name: str) -> bool:
+        return time.monotonic() - self.calibrated_at.get(model_name, float('-inf')) >= TOKEN_CALIBRATION_INTERVAL
+
+    def start_calibration(self, model_name: str) -> None:
+        # Marked up front, so concurrent requests don't all count the same model
+        self.calibrated_at[model_name] = time.monotonic()
+
+    def calibrate(self, model_name: str, chars: int, tokens: int) -> None:
+        if chars <= 0 or tokens <= 0:
+            return
+        measured = min(max(chars / tokens, 1.0), 8.0)
+        previous = self.ratios.get(model_name)
+        self.ratios[model_name] = measured if previous is None else (previous + measured) / 2
+
+
+def media_tokens(media: Any) -> int:
+    if media is None:
+        return 0
+    # Images are sent inline as PIL images, everything else as an uploaded file
+    return FILE_TOKENS if hasattr(media, 'uri') else IMAGE_TOKENS
+
+
+def history_token_budget(input_limit: int, *reserved: int) -> int:
+    """Tokens left for history once the margin and the reserved parts of the prompt are taken."""
+    return max(int(input_limit * (1 - PROMPT_TOKEN_MARGIN)) - sum(reserved), 0)
+
+
+def fit_history(history: List[Dict[str, Any]], max_tokens: int, estimator: TokenEstimator, model_name: str) -> List[Dict[str, Any]]:
+    """Keeps the newest items of a formatted history that fit within max_tokens."""
+    used = 0
+    start = len(history)
+    while start > 0:
+        tokens = estimator.estimate_parts(model_name, history[start - 1]["parts"])
+        if used + tokens > max_tokens:
+            break
+        used += tokens
+        start -= 1
+    return history[start:] if start else history
+
+
+# Shared by every guild; the cache file only changes when models are listed again
+model_limits = ModelLimits()
@@ -0,0 +1,127 @@
+import os
+import time
+import random
+import asyncio
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar('T')
+
+REPLY_DEADLINE = float(os.getenv('REPLY_DEADLINE', '60'))  # Seconds one reply may take, all attempts included
+RETRY_BUDGET = int(os.getenv('RETRY_BUDGET', '4'))  # Retries one reply may use, whatever failed
+
+# Error classes, as assigned by ErrorHandler.classify
+FATAL = 'fatal'  # Retrying gives the same answer: blocked prompts, bad arguments, missing permissions
+RATE_LIMITED = 'rate_limited'  # The key's quota ran out; retried at once with another key, otherwise after a wait
+TRANSIENT = 'transient'  # Server errors, timeouts and broken responses
+UNKNOWN = 'unknown'
+
+
+class RetryPolicy:
+    __slots__ = ('max_retries', 'base_delay', 'max_delay')
+
+    def __init__(self, max_retries: int, base_delay: float = 1.0, max_delay: float = 10.0):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, retry: int) -> float:
+        # Full jitter, so replies that failed together don't all come back at the same moment
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+
+RETRY_POLICIES: Dict[str, RetryPolicy] = {
+    FATAL: RetryPolicy(0),
+    RATE_LIMITED: RetryPolicy(3, base_delay=2.0, max_delay=20.0),
+    TRANSIENT: RetryPolicy(3, base_delay=1.0, max_delay=8.0),
+    UNKNOWN: RetryPolicy(1, base_delay=1.0, max_delay=4.0),
+}
+
+
+class RetryThrottle:
+    """
+    Shared by all replies: every failure costs a token and every success earns
+    back a fraction of one. Below half the tokens, failed attempts are no longer
+    retried, so an outage on Gemini's side doesn't get multiplied by retries
+    from every guild at once.
+    """
+
+    def __init__(self, max_tokens: float = 100.0, token_ratio: float = 0.1):
+        self.max_tokens = max_tokens
+        self.token_ratio = token_ratio
+        self.tokens = max_tokens
+
+    def record_success(self) -> None:
+        self.tokens = min(self.tokens + self.token_ratio, self.max_tokens)
+
+    def record_failure(self) -> None:
+        self.tokens = max(self.tokens - 1, 0.0)
+
+    def allows_retry(self) -> bool:
+        return self.tokens > self.max_tokens / 2
+
+
+class Deadline:
+    __slots__ = ('expires_at',)
+
+    def __init__(self, seconds: float = REPLY_DEADLINE):
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(self.expires_at - time.monotonic(), 0.0)
+
+
+class Retrier:
+    """
+    Runs one request's attempts until one succeeds or the request runs out of
+    time or retries. Each attempt is given the time left before the deadline,
+    and how a failure is retried depends on its error class.
+    """
+
+    def __init__(self, classify: Callable[[BaseException], str], deadline: Optional[Deadline] = None, budget: int = RETRY_BUDGET, policies: Dict[str, RetryPolicy] = RETRY_POLICIES, throttle: Optional['RetryThrottle'] = None):
+        self.classify = classify
+        self.deadline = deadline or Deadline()
+        self.budget = budget
+        self.policies = policies
+        self.throttle = throttle if throttle is not None else retry_throttle
+        self.retries: Dict[str, int] = {}
+
+    async def run(self, attempt: Callable[[float], Awaitable[T]], recover: Optional[Callable[[BaseException, str], Awaitable[bool]]] = None, observe: Optional[Callable[[Optional[BaseException], Optional[str]], None]] = None) -> T:
+        """
+        `attempt` gets the seconds it has left. After a failure that will be
+        retried, `recover` can switch whatever the next attempt uses; returning
+        True skips the backoff, e.g. after moving to a fresh API key. `observe`
+        sees the outcome of every attempt, timeouts included.
+        """
+        while True:
+            timeout = self.deadline.remaining()
+            if timeout <= 0:
+                raise asyncio.TimeoutError("The reply deadline passed before another attempt could start")
+            try:
+                result = await asyncio.wait_for(attempt(timeout), timeout)
+            except Exception as e:
+                error_class = self.classify(e)
+                if error_class != FATAL:
+                    # Only failures that say something about Gemini's health count against the throttle
+                    self.throttle.record_failure()
+                if observe:
+                    observe(e, error_class)
+                policy = self.policies.get(error_class, self.policies[UNKNOWN])
+                retry = self.retries.get(error_class, 0)
+                if retry >= policy.max_retries or sum(self.retries.values()) >= self.budget or not self.throttle.allows_retry():
+                    raise
+                self.retries[error_class] = retry + 1
+                skip_delay = await recover(e, error_class) if recover else False
+                delay = 0.0 if skip_delay else policy.delay(retry)
+                if delay >= self.deadline.remaining():
+                    raise
+                if delay:
+                    await asyncio.sleep(delay)
+                continue
+            self.throttle.record_success()
+            if observe:
+                observe(None, None)
+            return result
+
+
+# Shared by every reply, so the whole bot backs off together during an outage
+retry_throttle = RetryThrottle()
@@ -0,0 +1,63 @@
+import time
+from typing import Callable, List
+
+import discord
+
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between edits while a reply streams in; Discord allows about 5 per 5s
+
+
+class StreamingReply:
+    """
+    Shows a reply while it is still being generated. The first text is posted
+    as soon as it arrives and then kept up to date with rate-limited edits;
+    once it outgrows one Discord message, the text rolls over into a new one,
+    split the same way as a finished reply.
+    """
+
+    def __init__(self, channel: discord.abc.Messageable, split: Callable[[str], List[str]], edit_interval: float = STREAM_EDIT_INTERVAL):
+        self.channel = channel
+        self.split = split
+        self.edit_interval = edit_interval
+        self.messages: List[discord.Message] = []
+        self.shown: List[str] = []
+        self.last_sync = 0.0
+
+    async def update(self, text: str) -> None:
+        if not text.strip() or time.monotonic() - self.last_sync < self.edit_interval:
+            return
+        await self._sync(text)
+
+    async def finish(self, text: str) -> List[discord.Message]:
+        """Shows the final text, removes any messages it no longer needs and returns the rest."""
+        # A retried generation can end up shorter than what was already shown
+        needed = await self._sync(text)
+        while len(self.messages) > needed:
+            await self.messages.pop().delete()
+            self.shown.pop()
+        return self.messages
+
+    async def discard(self) -> None:
+        """Takes down everything shown so far; a later update or finish starts over with new messages."""
+        for bot_message in self.messages:
+            try:
+                await bot_message.delete()
+            except discord.HTTPException:
+                # Already gone or not ours to delete any more; nothing else depends on it
+                pass
+        self.messages = []
+        self.shown = []
+        self.last_sync = 0.0
+
+    async def _sync(self, text: str) -> int:
+        parts = [part for part in self.split(text) if part.strip()]
+        for index, part in enumerate(parts):
+            if index < len(self.messages):
+                # Parts before the last stop changing once the text has grown past them
+                if self.shown[index] != part:
+                    await self.messages[index].edit(content=part)
+                    self.shown[index] = part
+            else:
+                self.messages.append(await self.channel.send(part))
+                self.shown.append(part)
+        self.last_sync = time.monotonic()
+        return len(parts)
@@ -0,0 +1,264 @@
+import os
+import re
+import time
+import zlib
+import argparse
+from typing import Dict, List, Optional, Protocol, Sequence, Set, Tuple
+
+import numpy as np
+
+VECTOR_DIR = 'memories/vectors'
+VECTOR_DIM = int(os.getenv('VECTOR_DIM', '256'))
+INITIAL_CAPACITY = 1024
+
+
+class Embedder(Protocol):
+    dim: int
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        """Returns one L2-normalized float32 row per text."""
+        ...
+
+
+class HashingEmbedder:
+    """
+    Offline embedder that hashes words and word bigrams into a fixed number of
+    signed buckets. Needs no model or network, and is deterministic across runs.
+    """
+
+    def __init__(self, dim: int = VECTOR_DIM):
+        self.dim = dim
+
+    def _features(self, text: str) -> List[str]:
+        words = re.findall(r'\w+', text.lower())
+        return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+    def embed(self, texts: Sequence[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text or ''):
+                digest = zlib.crc32(feature.encode())
+                vectors[row, digest % self.dim] += 1.0 if digest & 0x80000000 else -1.0
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        np.divide(vectors, norms, out=vectors, where=norms > 0)
+        return vectors
+
+
+class GuildVectorIndex:
+    """
+    Memory-mapped float32 matrix of turn embeddings for one guild, with a
+    parallel int64 array holding each row's Discord message id (0 marks a free
+    row). Rows are added, overwritten and freed in place.
+    """
+
+    def __init__(self, path_prefix: str, dim: int):
+        self.vectors_path = f'{path_prefix}.f32'
+        self.ids_path = f'{path_prefix}.ids'
+        self.dim = dim
+        self.vectors: Optional[np.memmap] = None
+        self.ids: Optional[np.memmap] = None
+        self.capacity = 0
+        self.count = 0  # Rows in use or freed; everything past this is unused
+        self.slots: Dict[int, int] = {}
+        self.free: List[int] = []
+        if os.path.exists(self.vectors_path) and os.path.exists(self.ids_path):
+            self._load()
+
+    def _map(self, capacity: int) -> None:
+        self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, self.dim))
+        self.ids = np.memmap(self.ids_path, dtype=np.int64, mode='r+', shape=(capacity,))
+        self.capacity = capacity
+
+    def _load(self) -> None:
+        capacity = os.path.getsize(self.ids_path) // 8
+        if capacity == 0 or os.path.getsize(self.vectors_path) != capacity * self.dim * 4:
+            return
+        self._map(capacity)
+        used = np.nonzero(self.ids)[0]
+        self.count = int(used[-1]) + 1 if len(used) else 0
+        self.slots = {int(self.ids[slot]): int(slot) for slot in used}
+        self.free = [slot for slot in range(self.count) if not self.ids[slot]]
+
+    def _grow(self) -> None:
+        capacity = max(INITIAL_CAPACITY, self.capacity * 2)
+        self.flush()
+        self.vectors = self.ids = None
+        for path, row_bytes in ((self.vectors_path, self.dim * 4), (self.ids_path, 8)):
+            with open(path, 'ab') as f:
+                f.truncate(capacity * row_bytes)
+        self._map(capacity)
+
+    def upsert(self, message_id: int, vector: np.ndarray) -> None:
+        slot = self.slots.get(message_id)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+            else:
+                if self.count >= self.capacity:
+                    self._grow()
+                slot = self.count
+                self.count += 1
+            self.slots[message_id] = slot
+            self.ids[slot] = message_id
+        self.vectors[slot] = vector
+
+    def remove(self, message_id: int) -> None:
+        slot = self.slots.pop(message_id, None)
+        if slot is not None:
+            self.ids[slot] = 0
+            self.vectors[slot] = 0
+            self.free.append(slot)
+
+    def rename(self, old_id: int, new_id: int) -> None:
+        slot = self.slots.pop(old_id, None)
+        if slot is not None:
+            self.slots[new_id] = slot
+            self.ids[slot] = new_id
+
+    def remove_before(self, message_id: int) -> None:
+        for old_id in [old_id for old_id in self.slots if old_id < message_id]:
+            self.remove(old_id)
+
+    def clear(self) -> None:
+        for old_id in list(self.slots):
+            self.remove(old_id)
+
+    def search(self, query: np.ndarray, limit: int, before_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        if not self.slots or limit <= 0:
+            return []
+        ids = np.asarray(self.ids[:self.count])
+        scores = np.asarray(self.vectors[:self.count]) @ query
+        # Turns sharing no features with the query are not worth recalling
+        valid = (ids != 0) & (scores > 0)
+        if before_id is not None:
+            valid &= ids < before_id
+        scores = np.where(valid, scores, -np.inf)
+
+        limit = min(limit, int(valid.sum()))
+        if limit == 0:
+            return []
+        top = np.argpartition(-scores, limit - 1)[:limit]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[slot]), float(scores[slot])) for slot in top]
+
+    def flush(self) -> None:
+        if self.vectors is not None:
+            self.vectors.flush()
+            self.ids.flush()
+
+
+class VectorMemory:
+    """
+    Per-guild long-term memory over history turns. A guild only gets an index
+    once something asks for one with `create`; writes for guilds without an
+    index are ignored, so guilds that never use vector recall pay nothing.
+    """
+
+    def __init__(self, embedder: Optional[Embedder] = None, directory: str = VECTOR_DIR):
+        self.embedder = embedder or HashingEmbedder()
+        self.directory = directory
+        self.indexes: Dict[str, GuildVectorIndex] = {}
+        self.missing: Set[str] = set()
+
+    def _path_prefix(self, guild_id: str) -> str:
+        return os.path.join(self.directory, f'{guild_id}_{self.embedder.dim}')
+
+    def get(self, guild_id: str) -> Optional[GuildVectorIndex]:
+        index = self.indexes.get(guild_id)
+        if index is not None or guild_id in self.missing:
+            return index
+        if os.path.exists(self._path_prefix(guild_id) + '.ids'):
+            index = self.indexes[guild_id] = GuildVectorIndex(self._path_prefix(guild_id), self.embedder.dim)
+            return index
+        self.missing.add(guild_id)
+        return None
+
+    def create(self, guild_id: str) -> GuildVectorIndex:
+        index = self.get(guild_id)
+        if index is None:
+            os.makedirs(self.directory, exist_ok=True)
+            index = self.indexes[guild_id] = GuildVectorIndex(self._path_prefix(guild_id), self.embedder.dim)
+            self.missing.discard(guild_id)
+        return index
+
+    def upsert_many(self, guild_id: str, turns: Sequence[Tuple[str, str]]) -> None:
+        index = self.get(guild_id)
+        turns = [(message_id, content) for message_id, content in turns if message_id.isdigit()]
+        if index is None or not turns:
+            return
+        vectors = self.embedder.embed([content for _, content in turns])
+        for (message_id, _), vector in zip(turns, vectors):
+            index.upsert(int(message_id), vector)
+
+    def remove(self, guild_id: str, message_id: str) -> None:
+        index = self.get(guild_id)
+        if index is not None and message_id.isdigit():
+            index.remove(int(message_id))
+
+    def rename(self, guild_id: str, old_id: str, new_id: str) -> None:
+        index = self.get(guild_id)
+        if index is not None and old_id.isdigit() and new_id.isdigit():
+            index.rename(int(old_id), int(new_id))
+
+    def remove_before(self, guild_id: str, sort_key: int) -> None:
+        index = self.get(guild_id)
+        if index is not None:
+            index.remove_before(sort_key)
+
+    def clear(self, guild_id: str) -> None:
+        index = self.get(guild_id)
+        if index is not None:
+            index.clear()
+
+    def search(self, guild_id: str, text: str, limit: int, before_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        index = self.get(guild_id)
+        if index is None:
+            return []
+        return index.search(self.embedder.embed([text])[0], limit, before_id)
+
+    def close(self) -> None:
+        for index in self.indexes.values():
+            index.flush()
+        self.indexes.clear()
+        self.missing.clear()
+
+
+def benchmark(turns: int, queries: int, dim: int) -> None:
+    import tempfile
+
+    words = [f'word{i}' for i in range(5000)]
+    rng = np.random.default_rng(0)
+    texts = [' '.join(rng.choice(words, size=24)) for _ in range(turns)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        memory = VectorMemory(HashingEmbedder(dim), directory)
+        memory.create('benchmark')
+        start = time.perf_counter()
+        for offset in range(0, turns, 1000):
+            memory.upsert_many('benchmark', [(str(offset + i + 1), text) for i, text in enumerate(texts[offset:offset + 1000])])
+        build_time = time.perf_counter() - start
+
+        timings = []
+        for text in rng.choice(texts, size=queries):
+            start = time.perf_counter()
+            memory.search('benchmark', text, 8)
+            timings.append(time.perf_counter() - start)
+        memory.close()
+
+    timings.sort()
+    print(f"Indexed {turns} turns at dim {dim} in {build_time:.2f}s")
+    print(f"Query latency over {queries} queries: p50 {timings[len(timings) // 2] * 1000:.2f} ms, "
+          f"p95 {timings[int(len(timings) * 0.95)] * 1000:.2f} ms, max {timings[-1] * 1000:.2f} ms")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark vector memory query latency.")
+    parser.add_argument('--turns', type=int, default=100000, help="Turns indexed for one guild")
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--dim', type=int, default=VECTOR_DIM)
+    args = parser.parse_args()
+    benchmark(args.turns, args.queries, args.dim)
+
+
+if __name__ == "__main__":
+    main()
@@ -9,8 +9,11 @@ from lib.alicia_presence_manager import AliciaPresenceManager
 from lib.config_manager import ConfigManager
 from lib.error_handler import ErrorHandler
 from lib.gemini_model import GeminiModel
-from lib import guild_interaction_db
+from lib import guild_interaction_db, history_backup
 from lib.api_manager import APIManager
+from lib.job_scheduler import JobScheduler, QueueFull
+from lib.message_coalescer import MessageCoalescer, COALESCE_WINDOW
+from lib.streaming_reply import StreamingReply
 
 from commands.settings_manager import setup_commands as setup_extra_commands
 from commands.help_menu import setup_help_command
@@ -18,6 +21,7 @@ from commands.config_command import ConfigModal, SystemInstructionModal
 from commands.safety_command import setup as setup_safety
 from commands.channel_command import setup as setup_channel
 from commands.import_instruction import setup as setup_import_instruction
+from commands.status_command import setup as setup_status
 
 # Load environment variables
 load_dotenv()
@@ -40,6 +44,10 @@ class AliciaBot(discord.Client):
         self.api_manager = APIManager(self.config_manager)
         self.gemini_model = GeminiModel(self.api_manager, self.config_manager, self.error_handler)
         self.guild_history_manager = guild_interaction_db
+        # Rapid messages in a channel are answered together, for guilds with a coalesce window
+        self.coalescer = MessageCoalescer(self.answer_burst)
+        # Every reply waits here for its turn, so one busy guild can't take all the capacity
+        self.scheduler = JobScheduler()
 
     async def setup_hook(self):
         # Load or create default config
@@ -48,12 +56,19 @@ class AliciaBot(discord.Client):
         # Initialize GeminiModel
         await self.gemini_model.initialize()
 
+        # Start evicting idle history database connections; the model doubles as the
+        # summarizer that compacts old history while a guild is idle
+        guild_interaction_db.start(self.gemini_model)
+        # Scheduled snapshots of the history databases, if BACKUP_INTERVAL_HOURS is set
+        history_backup.start()
+
         # Setup commands
         await setup_extra_commands(self.tree, self, self.config_manager, self.api_manager)
         await setup_help_command(self.tree)
         await setup_safety(self.tree)
         await setup_channel(self.tree)
         await setup_import_instruction(self.tree)
+        await setup_status(self.tree)
 
         # Initialize the AliciaPresenceManager
         self.presence_manager = AliciaPresenceManager(self)
@@ -72,11 +87,19 @@ class AliciaBot(discord.Client):
         print(f'{self.user} has connected to Discord!')
         await self.sync_all_guilds()
 
+    async def on_resumed(self):
+        # Catch up on anything missed while the gateway connection was down
+        await self.sync_all_guilds()
+
     async def sync_all_guilds(self):
+        tasks = []
         for guild in self.guilds:
             config = await self.config_manager.get_guild_config(str(guild.id))
             for channel_id in config.get("allowed_channels", []):
-                await guild_interaction_db.sync_bot_user_messages(str(guild.id), channel_id, self)
+                task = guild_interaction_db.schedule_sync(str(guild.id), channel_id, self)
+                if task:
+                    tasks.append(task)
+        await asyncio.gather(*tasks)
 
     async def periodic_sync(self):
         while not self.is_closed():
@@ -86,7 +109,11 @@ class AliciaBot(discord.Client):
     async def close(self):
         if self.sync_task:
             self.sync_task.cancel()
+        self.coalescer.close()
+        history_backup.close()
         await super().close()
+        self.gemini_model.close()
+        await guild_interaction_db.close()
 
     async def on_message(self, message: discord.Message):
         if message.author == self.user:
@@ -111,14 +138,15 @@ class AliciaBot(discord.Client):
         await guild_interaction_db.edit_guild_history(
             str(after.guild.id),
             {"role": "user", "parts": [f"{after.author.display_name}: {after.content}"]},
-            str(after.id)
+            str(after.id),
+            channel_id=after.channel.id
         )
 
     async def on_message_delete(self, message: discord.Message):
         if message.guild is None:
             return
         
-        await guild_interaction_db.remove_message_from_history(str(message.guild.id), str(message.id))
+        await guild_interaction_db.remove_message_from_history(str(message.guild.id), str(message.id), channel_id=message.channel.id)
 
     async def process_message(self, message: discord.Message):
         guild_config = await self.config_manager.get_guild_config(str(message.guild.id))
@@ -129,50 +157,87 @@ class AliciaBot(discord.Client):
         if guild_config["require_mention"] and self.user not in message.mentions:
             return
 
-        # Sync messages before processing
-        await guild_interaction_db.sync_bot_user_messages(str(message.guild.id), message.channel.id, self)
-
         await guild_interaction_db.update_guild_history(
             str(message.guild.id),
             {"role": "user", "parts": [f"{message.author.display_name}: {message.content}"]},
-            str(message.id)
+            str(message.id),
+            channel_id=message.channel.id
         )
 
-        await self.generate_and_send_response(message, guild_config)
-
-    async def generate_and_send_response(self, message: discord.Message, guild_config: Dict[str, Any]):
-        start_time = asyncio.get_event_loop().time()
-        max_retry_time = 60  # 1 minute
-
-        while asyncio.get_event_loop().time() - start_time < max_retry_time:
-            try:
-                response = await self.gemini_model.generate_response(
-                    message,
-                    str(message.guild.id),
-                    self.config_manager.get_guild_config,
-                    guild_interaction_db.get_guild_history
-                )
-                
+        # Each message is stored above on its own; only the reply waits for the burst to end
+        coalesce_window = guild_config.get("coalesce_window", COALESCE_WINDOW)
+        if coalesce_window > 0:
+            self.coalescer.submit(message, coalesce_window)
+            return
+
+        await self.schedule_response([message], guild_config)
+
+    async def answer_burst(self, messages: List[discord.Message]):
+        guild_config = await self.config_manager.get_guild_config(str(messages[-1].guild.id))
+        await self.schedule_response(messages, guild_config)
+
+    async def schedule_response(self, messages: List[discord.Message], guild_config: Dict[str, Any]):
+        message = messages[-1]
+        try:
+            await self.scheduler.run(
+                str(message.guild.id),
+                message.channel.id,
+                lambda: self.generate_and_send_response(message, guild_config, messages if len(messages) > 1 else None),
+                # Where every message needs a mention this is every job; elsewhere mentions skip ahead of chatter
+                priority=any(self.user in burst_message.mentions for burst_message in messages),
+                weight=guild_config.get("scheduler_weight", 1.0)
+            )
+        except QueueFull as e:
+            print(f"Not replying to message {message.id}: {e}")
+
+    async def generate_and_send_response(self, message: discord.Message, guild_config: Dict[str, Any], burst: Optional[List[discord.Message]] = None):
+        # Streamed replies show up while they are generated instead of all at once at the end
+        reply = StreamingReply(message.channel, self.split_message) if guild_config.get("stream_responses", False) else None
+        try:
+            response = await self.gemini_model.generate_response(
+                message,
+                str(message.guild.id),
+                self.config_manager.get_guild_config,
+                guild_interaction_db.get_recent_history,
+                guild_interaction_db.search_history,
+                guild_interaction_db.get_history_summaries,
+                on_partial=reply.update if reply else None,
+                on_retry=reply.discard if reply else None,
+                burst=burst
+            )
+            # From here on the reply is sent even if more messages arrive
+            self.coalescer.settle(message.channel.id)
+            
+            if reply:
+                bot_messages = await reply.finish(response)
+                if not bot_messages:
+                    return
+            else:
                 response_parts = self.split_message(response)
                 bot_messages = []
-                
+
                 for part in response_parts:
                     bot_message = await message.channel.send(part)
                     bot_messages.append(bot_message)
-                
-                full_response = {"role": "model", "parts": [response]}
-                for bot_message in bot_messages:
-                    await guild_interaction_db.update_guild_history(str(message.guild.id), full_response, str(bot_message.id))
-                
-                return
-            except Exception as e:
-                await self.error_handler.log_error(e)
-                error_result = await self.error_handler.handle_error(e, message.channel)
-                if error_result is not None:
-                    return
-                await asyncio.sleep(5)
-
-        await message.channel.send(embed=discord.Embed(title="Error", description="I'm sorry, but I couldn't get a response after trying for a minute. Please try again later.", color=discord.Color.red()))
+            
+            # The final text is stored once under its first message; the other chunks only map to it
+            full_response = {"role": "model", "parts": [response]}
+            await guild_interaction_db.update_guild_history(
+                str(message.guild.id), full_response, str(bot_messages[0].id), wait=False,
+                channel_id=message.channel.id, chunk_ids=[str(bot_message.id) for bot_message in bot_messages[1:]]
+            )
+        except asyncio.CancelledError:
+            # Superseded by a newer message in a coalesced burst, which is answered instead
+            if reply:
+                await reply.discard()
+            raise
+        except Exception as e:
+            if reply:
+                await reply.discard()
+            await self.error_handler.log_error(e)
+            error_result = await self.error_handler.handle_error(e, message.channel)
+            if error_result is None:
+                await message.channel.send(embed=discord.Embed(title="Error", description="I'm sorry, but I couldn't get a response in time. Please try again later.", color=discord.Color.red()))
 
     @staticmethod
     def split_message(message: str, max_length: int = 2000) -> List[str]: